@@ -1,12 +1,14 @@
 import csv
 import json
 from decimal import Decimal
+from functools import partial
 from io import StringIO
 
 from django.conf import settings
 from django.contrib import admin, messages
 from django.contrib.admin import helpers
 from django.core.exceptions import PermissionDenied
+from django.db import transaction
 from django.db.models import Case, F, NullBooleanField, Sum, Value, When
 from django.shortcuts import redirect
 from django.template.response import TemplateResponse
@@ -18,7 +20,8 @@ import dateutil.parser
 
 from .admin_utils import make_nullfilter
 from .models import Customer, Order, Payment, PaymentStatus, Plan, Product, Subscription
-from .utils import dicts_to_csv_response, send_lastschrift_mail
+from .tasks import send_lastschrift_mail_task
+from .utils import dicts_to_csv_response
 
 
 class PlanAdmin(admin.ModelAdmin):
@@ -300,7 +303,10 @@ class PaymentAdmin(admin.ModelAdmin):
         filename = "lastschrift_{}.csv".format(
             timezone.now().isoformat(timespec="minutes")
         )
-        dict_generator = (get_lastschrift_export(payment) for payment in queryset)
+        dict_generator = (
+            get_lastschrift_export(payment)
+            for payment in queryset.iterator(chunk_size=2000)
+        )
         return dicts_to_csv_response(dict_generator, name=filename)
 
     def import_lastschrift_result(self, request):
@@ -378,7 +384,10 @@ class PaymentAdmin(admin.ModelAdmin):
             mandate_qs = mandate_qs.select_related("order")
             count = 0
             for payment in mandate_qs:
-                send_lastschrift_mail(payment, note=note)
+                # Render + SMTP happens in the worker, not the request
+                transaction.on_commit(
+                    partial(send_lastschrift_mail_task.delay, payment.id, note=note)
+                )
                 payment.attrs.mandate_sent = mandate_sent
                 payment.save()
                 count += 1
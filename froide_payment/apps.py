@@ -7,8 +7,15 @@ class FroidePaymentConfig(AppConfig):
     verbose_name = _("Froide Payment App")
 
     def ready(self):
+        from django.db.models.signals import post_delete, post_save
+
         from payments.signals import status_changed
 
         from .listeners import subscription_payment
+        from .models import Plan, Product
+        from .provider.mixins import clear_plan_product_cache
 
         status_changed.connect(subscription_payment)
+        for model in (Plan, Product):
+            post_save.connect(clear_plan_product_cache, sender=model)
+            post_delete.connect(clear_plan_product_cache, sender=model)
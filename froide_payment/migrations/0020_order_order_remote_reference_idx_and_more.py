@@ -0,0 +1,26 @@
+# Generated by Django 5.2.17 on 2026-08-27 22:38
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("froide_payment", "0019_subscription_subscription_unique_remote_reference"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                fields=["remote_reference"], name="order_remote_reference_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["transaction_id"], name="payment_transaction_id_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.17 on 2026-08-27 22:56
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("froide_payment", "0020_order_order_remote_reference_idx_and_more"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(
+                fields=["subscription", "-created"],
+                name="order_subscription_created_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.17 on 2026-08-27 22:57
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("froide_payment", "0021_order_order_subscription_created_idx"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="customer",
+            index=models.Index(fields=["created"], name="customer_created_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(fields=["created"], name="order_created_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["status", "created"], name="payment_status_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                condition=models.Q(("status__in", ["waiting", "input", "pending"])),
+                fields=["order", "variant"],
+                name="payment_active_by_order",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="subscription",
+            index=models.Index(fields=["created"], name="subscription_created_idx"),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.17 on 2026-08-27 23:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("froide_payment", "0022_customer_customer_created_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["order", "status"], name="payment_order_status_idx"
+            ),
+        ),
+    ]
@@ -123,6 +123,9 @@ class Customer(models.Model):
 
     class Meta:
         ordering = ("-created",)
+        indexes = [
+            models.Index(fields=["created"], name="customer_created_idx"),
+        ]
 
     def __str__(self):
         return self.user_email
@@ -163,6 +166,9 @@ class Subscription(models.Model):
                 condition=~models.Q(remote_reference=""),
             ),
         ]
+        indexes = [
+            models.Index(fields=["created"], name="subscription_created_idx"),
+        ]
 
     def __str__(self):
         return str(self.customer)
@@ -185,11 +191,12 @@ class Subscription(models.Model):
         return self.orders.all().order_by("service_end").first()
 
     def attach_order_info(self, remote_reference="", **extra):
-        order = self.get_last_order()
-        if not order:
+        last_order_pk = (
+            self.orders.order_by("-service_end").values_list("pk", flat=True).first()
+        )
+        if last_order_pk is None:
             return
-        order.remote_reference = remote_reference
-        order.save()
+        Order.objects.filter(pk=last_order_pk).update(remote_reference=remote_reference)
 
     def create_recurring_order(
         self,
@@ -215,6 +222,7 @@ class Subscription(models.Model):
         is_donation=True,
         remote_reference="",
         remote_reference_is_unique=False,
+        last_order=None,
     ):
         existing_order = Order.objects.filter(remote_reference=remote_reference)
         if remote_reference_is_unique and existing_order.exists():
@@ -225,7 +233,8 @@ class Subscription(models.Model):
 
         now = timezone.now()
 
-        last_order = self.get_last_order()
+        if last_order is None:
+            last_order = self.get_last_order()
         service_start = None
         if last_order:
             service_start = last_order.service_end
@@ -275,11 +284,13 @@ class Subscription(models.Model):
         return provider.get_modify_info(self)
 
     def cancel(self):
+        # The provider call runs first, outside any transaction, so no
+        # DB locks are held during the PSP round trip
         provider = self.get_provider()
         success = provider.cancel_subscription(self)
         self.active = False
         self.canceled = timezone.now()
-        self.save()
+        self.save(update_fields=["active", "canceled"])
         subscription_canceled.send(sender=self)
         return success
 
@@ -361,6 +372,21 @@ class Order(models.Model):
                 condition=models.Q(remote_reference_is_unique=True),
             ),
         ]
+        indexes = [
+            # Webhook lookups filter on remote_reference alone, which
+            # the conditional constraints above do not cover
+            models.Index(
+                fields=["remote_reference"], name="order_remote_reference_idx"
+            ),
+            # Subscription detail slices the newest orders per
+            # subscription
+            models.Index(
+                fields=["subscription", "-created"],
+                name="order_subscription_created_idx",
+            ),
+            # cleanup() prunes by age
+            models.Index(fields=["created"], name="order_created_idx"),
+        ]
 
     def __str__(self):
         return self.description
@@ -504,13 +530,25 @@ class Order(models.Model):
         return self.subscription.plan.get_interval_description()
 
     def get_or_create_payment(self, variant, request=None):
-        defaults = get_payment_defaults(self, request=request)
         with transaction.atomic():
-            payment, created = Payment.objects.filter(
+            # Row-level lock so concurrent starts serialize on the
+            # existing payment instead of racing to create duplicates
+            active_payments = Payment.objects.select_for_update().filter(
                 models.Q(status=PaymentStatus.WAITING)
                 | models.Q(status=PaymentStatus.INPUT)
                 | models.Q(status=PaymentStatus.PENDING)
-            ).get_or_create(variant=variant, order=self, defaults=defaults)
+            )
+            try:
+                payment = active_payments.get(variant=variant, order=self)
+                created = False
+            except Payment.DoesNotExist:
+                # Only build the defaults when the payment is
+                # actually created
+                payment, created = active_payments.get_or_create(
+                    variant=variant,
+                    order=self,
+                    defaults=get_payment_defaults(self, request=request),
+                )
             if created:
                 # Delete waiting/input payments from before
                 Payment.objects.filter(
@@ -519,7 +557,6 @@ class Order(models.Model):
                 ).filter(order=self).exclude(id=payment.id).delete()
         # Trigger signal
         payment.change_status(payment.status)
-        payment.save()
         return payment
 
 
@@ -556,12 +593,6 @@ class Payment(BasePayment):
     )
     received_timestamp = models.DateTimeField(null=True, blank=True)
 
-    # FIXME: transaction_id probably needs a db index
-    # transaction_id = models.CharField(
-    #     max_length=255, blank=True,
-    #     db_index=True
-    # )
-
     class Meta:
         ordering = ("-modified",)
         constraints = [
@@ -571,6 +602,28 @@ class Payment(BasePayment):
                 condition=~models.Q(transaction_id=""),
             ),
         ]
+        indexes = [
+            models.Index(fields=["transaction_id"], name="payment_transaction_id_idx"),
+            # cleanup() prunes stale waiting/input payments by age
+            models.Index(
+                fields=["status", "created"], name="payment_status_created_idx"
+            ),
+            # Confirmed-payment EXISTS probes in the order views
+            models.Index(fields=["order", "status"], name="payment_order_status_idx"),
+            # Small partial index backing the active-payment probe in
+            # Order.get_or_create_payment
+            models.Index(
+                fields=["order", "variant"],
+                name="payment_active_by_order",
+                condition=models.Q(
+                    status__in=[
+                        PaymentStatus.WAITING,
+                        PaymentStatus.INPUT,
+                        PaymentStatus.PENDING,
+                    ]
+                ),
+            ),
+        ]
 
     STATUS_COLORS = {
         PaymentStatus.WAITING: "secondary",
@@ -585,6 +638,22 @@ class Payment(BasePayment):
         PaymentStatus.CANCELED: "dark",
     }
 
+    @property
+    def amount_cents(self):
+        # Providers take integer cents
+        return int(self.total * 100)
+
+    def change_status_with_fields(self, status, update_fields, message=""):
+        """Like change_status, but folds the status change and the
+        other just-mutated columns into a single UPDATE before sending
+        the status_changed signal."""
+        from payments.signals import status_changed
+
+        self.status = status
+        self.message = message
+        self.save(update_fields=[*update_fields, "status", "message", "modified"])
+        status_changed.send(sender=type(self), instance=self)
+
     def __str__(self):
         return "{}: {} ({} {} - {})".format(
             self.order,
@@ -15,8 +15,9 @@ class IBANProviderMixin:
         Lastschrift gets stored and processed
         """
         if payment.status == PaymentStatus.WAITING:
-            payment.change_status(PaymentStatus.INPUT)
-            payment.save()
+            # Bump modified along with the status, it is the payment's
+            # ordering and display timestamp
+            payment.change_status_with_fields(PaymentStatus.INPUT, [])
 
         iban = None
         try:
@@ -29,8 +30,7 @@ class IBANProviderMixin:
 
         if iban is not None:
             if payment.status == PaymentStatus.INPUT:
-                payment.change_status(PaymentStatus.PENDING)
-                payment.save()
+                payment.change_status_with_fields(PaymentStatus.PENDING, [])
             raise RedirectNeeded(payment.get_success_url())
 
         form = self.form_class(
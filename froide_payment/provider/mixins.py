@@ -1,15 +1,78 @@
 from decimal import Decimal
+from functools import lru_cache
 
+from django.core.cache import cache
 from django.utils.text import slugify
 
 from ..models import Plan, Product
 
+PLAN_PRODUCT_CACHE_TTL = 3600
+
+
+def product_cache_key(category, provider):
+    return "froide_payment:product:{}:{}".format(provider, category)
+
+
+def plan_cache_key(product_pk, amount, interval, provider):
+    return "froide_payment:plan:{}:{}:{}:{}".format(
+        provider, product_pk, amount, interval
+    )
+
+
+@lru_cache(maxsize=256)
+def product_pk_lookup(category, provider):
+    # Product rows are near-immutable, cache the PK lookup in process
+    # and in the shared cache. Misses raise DoesNotExist, they are
+    # neither cached nor shared.
+    key = product_cache_key(category, provider)
+    pk = cache.get(key)
+    if pk is None:
+        pk = Product.objects.values_list("pk", flat=True).get(
+            category=category, provider=provider
+        )
+        cache.set(key, pk, PLAN_PRODUCT_CACHE_TTL)
+    return pk
+
+
+@lru_cache(maxsize=256)
+def plan_pk_lookup(product_pk, amount, interval, provider):
+    key = plan_cache_key(product_pk, amount, interval, provider)
+    pk = cache.get(key)
+    if pk is None:
+        pk = Plan.objects.values_list("pk", flat=True).get(
+            product_id=product_pk,
+            amount=amount,
+            interval=interval,
+            provider=provider,
+        )
+        cache.set(key, pk, PLAN_PRODUCT_CACHE_TTL)
+    return pk
+
+
+def clear_plan_product_cache(sender, instance, **kwargs):
+    # Drop the shared cache entry for the changed row as well, other
+    # processes neither see the signal nor the lru_cache clear and
+    # would keep resolving a stale pk for up to the TTL
+    if isinstance(instance, Product):
+        cache.delete(product_cache_key(instance.category, instance.provider))
+    else:
+        cache.delete(
+            plan_cache_key(
+                instance.product_id,
+                instance.amount,
+                instance.interval,
+                instance.provider,
+            )
+        )
+    product_pk_lookup.cache_clear()
+    plan_pk_lookup.cache_clear()
+
 
 class PlanProductMixin:
     def get_or_create_product(self, category):
         try:
-            product = Product.objects.get(
-                category=category, provider=self.provider_name
+            return Product.objects.get(
+                pk=product_pk_lookup(category, self.provider_name)
             )
         except Product.DoesNotExist:
             product = Product.objects.create(
@@ -24,11 +87,10 @@ class PlanProductMixin:
     def get_or_create_plan(self, plan_name, category, amount, month_interval):
         product = self.get_or_create_product(category)
         try:
-            plan = Plan.objects.get(
-                product=product,
-                amount=amount,
-                interval=month_interval,
-                provider=self.provider_name,
+            return Plan.objects.get(
+                pk=plan_pk_lookup(
+                    product.pk, amount, month_interval, self.provider_name
+                )
             )
         except Plan.DoesNotExist:
             plan = Plan.objects.create(
@@ -37,7 +99,7 @@ class PlanProductMixin:
                 category=category,
                 amount=amount,
                 interval=month_interval,
-                amount_year=amount * Decimal(12 / month_interval),
+                amount_year=amount * 12 / Decimal(month_interval),
                 provider=self.provider_name,
                 product=product,
             )
@@ -1,11 +1,25 @@
-import json
+import base64
+import binascii
 import logging
-from datetime import timedelta
+import ssl
+from datetime import datetime, timedelta
+from datetime import timezone as tz
 from decimal import ROUND_HALF_UP, Decimal
+from urllib.parse import urlsplit
 
 import dateutil.parser
+import certifi
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.x509 import load_pem_x509_certificate
 from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import redirect
 from django.utils import timezone
@@ -15,22 +29,63 @@ from payments import PaymentError, RedirectNeeded
 from payments.core import BasicProvider
 
 from ..models import Payment, PaymentStatus, Plan, Product, Subscription
-from ..signals import (
-    subscription_activated,
-    subscription_canceled,
-    subscription_deactivated,
-)
+from ..signals import subscription_activated, subscription_canceled
+from .mixins import plan_pk_lookup, product_pk_lookup
 from .utils import CancelInfo, ModifyInfo
 
 logger = logging.getLogger(__name__)
 
 CENTS = Decimal("0.01")
 
+# There are only a handful of currency codes, cache the uppercased form
+_CURRENCY_UPPER = {}
+
+
+def _upper_currency(currency):
+    try:
+        return _CURRENCY_UPPER[currency]
+    except KeyError:
+        return _CURRENCY_UPPER.setdefault(currency, currency.upper())
+
+
+def _loads(data):
+    return orjson.loads(data)
+
+
+def _dumps(obj):
+    # orjson serializes to bytes; extra_data is stored as text
+    return orjson.dumps(obj, default=str).decode()
+
+
+class SSLContextAdapter(HTTPAdapter):
+    """Reuse a single prebuilt SSLContext for all pooled connections"""
+
+    def __init__(self, ssl_context=None, **kwargs):
+        self._ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self._ssl_context is not None:
+            kwargs["ssl_context"] = self._ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+
+def _index_links(response):
+    return {link["rel"]: link["href"] for link in response.get("links", [])}
+
 
 def utcisoformat(dt):
     if timezone.is_aware(dt):
-        dt = timezone.localtime(dt, timezone=timezone.utc)
-    return dt.replace(microsecond=0).replace(tzinfo=None).isoformat() + "Z"
+        dt = dt.astimezone(tz.utc)
+    return dt.replace(microsecond=0, tzinfo=None).isoformat() + "Z"
+
+
+def _parse_iso(value):
+    # Paypal emits strict ISO-8601, fromisoformat is much faster than dateutil
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return dateutil.parser.parse(value)
 
 
 class PaypalProvider(BasicProvider):
@@ -50,6 +105,38 @@ class PaypalProvider(BasicProvider):
         self.webhook_id = webhook_id
         self.oauth2_url = self.endpoint + "/v1/oauth2/token"
         self.order_url = self.endpoint + "/v2/checkout/orders"
+        self.session = requests.Session()
+        # Back off on rate limits and transient server errors,
+        # honoring Paypal's Retry-After header. Only idempotent reads
+        # are replayed automatically: an ambiguous 5xx on a POST (e.g.
+        # a proxy 502 after a capture executed) must not be re-sent,
+        # mutating calls carry a Paypal-Request-Id instead so Paypal
+        # deduplicates application-level retries
+        retry = Retry(
+            total=4,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+        )
+        if settings.DEBUG:
+            self.session.verify = False
+            adapter = HTTPAdapter(max_retries=retry)
+        else:
+            ssl_context = ssl.create_default_context(cafile=certifi.where())
+            adapter = SSLContextAdapter(ssl_context=ssl_context, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._webhook_dispatch = {
+            "BILLING.SUBSCRIPTION.ACTIVATED": (
+                self.webhook_billing_subscription_activated
+            ),
+            "BILLING.SUBSCRIPTION.CANCELLED": (
+                self.webhook_billing_subscription_cancelled
+            ),
+            "PAYMENT.CAPTURE.COMPLETED": self.webhook_payment_capture_completed,
+            "PAYMENT.SALE.COMPLETED": self.webhook_payment_sale_completed,
+        }
         super().__init__(capture=capture)
 
     def get_cancel_info(self, subscription):
@@ -72,25 +159,28 @@ class PaypalProvider(BasicProvider):
         if not payment.id:
             payment.save()
         links = self._get_links(payment)
-        redirect_to = links.get("approve")
-        if not redirect_to:
+        approve_url = links.get("approve")
+        if not approve_url:
             approve_url = self.create_order(payment)
-        else:
-            approve_url = redirect_to["href"]
         payment.change_status(PaymentStatus.INPUT)
         payment.save()
         raise RedirectNeeded(approve_url)
 
     def create_order(self, payment, extra_data=None):
         product_data = self.get_product_data(payment, extra_data)
-        payment_data = self.post_api(self.order_url, product_data)
+        payment_data = self.post_api(
+            self.order_url,
+            product_data,
+            request_id="{}:create-order".format(payment.token),
+        )
         self.set_response_data(payment, payment_data)
         links = self._get_links(payment)
-        redirect_to = links["approve"]
-        return redirect_to["href"]
+        return links["approve"]
 
     def get_transactions_data(self, payment):
-        total = payment.total.quantize(CENTS, rounding=ROUND_HALF_UP)
+        total = payment.total
+        if total.as_tuple().exponent != -2:
+            total = total.quantize(CENTS, rounding=ROUND_HALF_UP)
         data = {
             "purchase_units": [
                 {
@@ -99,7 +189,7 @@ class PaypalProvider(BasicProvider):
                     "invoice_id": str(payment.order.token),
                     "amount": {
                         "value": str(total),
-                        "currency_code": payment.currency.upper(),
+                        "currency_code": _upper_currency(payment.currency),
                     },
                 }
             ],
@@ -130,34 +220,48 @@ class PaypalProvider(BasicProvider):
             return self.process_order(payment, request)
         return self.finalize_subscription(payment)
 
+    def _extra(self, payment):
+        # Cache the parsed extra_data dict on the payment instance,
+        # it is read several times within one request
+        if not hasattr(payment, "_extra_cache"):
+            payment._extra_cache = _loads(payment.extra_data or "{}")
+        return payment._extra_cache
+
+    def _save_extra(self, payment, update_fields):
+        payment.extra_data = _dumps(self._extra(payment))
+        payment.save(update_fields=[*update_fields, "modified"])
+
     def set_response_data(self, payment, response):
-        extra_data = json.loads(payment.extra_data or "{}")
+        extra_data = self._extra(payment)
         extra_data["response"] = response
         if "links" in response:
-            extra_data["links"] = {link["rel"]: link for link in response["links"]}
-        payment.extra_data = json.dumps(extra_data)
+            extra_data["links"] = _index_links(response)
         payment.transaction_id = response["id"]
-        payment.save(update_fields=["transaction_id", "extra_data"])
+        self._save_extra(payment, ["transaction_id", "extra_data"])
 
     def set_error_data(self, payment, error):
-        extra_data = json.loads(payment.extra_data or "{}")
+        extra_data = self._extra(payment)
         extra_data["error"] = error
-        payment.extra_data = json.dumps(extra_data)
-        payment.save(update_fields=["extra_data"])
+        self._save_extra(payment, ["extra_data"])
 
     def capture_payment(self, payment):
         links = self._get_links(payment)
         if "capture" not in links:
             raise ValueError("Could not capture")
-        capture_url = links["capture"]["href"]
-        response = self.post_api(capture_url, {})
+        capture_url = links["capture"]
+        response = self.post_api(
+            capture_url, {}, request_id="{}:capture".format(payment.token)
+        )
         self.set_response_data(payment, response)
         return response
 
     def _get_links(self, payment):
-        extra_data = json.loads(payment.extra_data or "{}")
-        links = extra_data.get("links", {})
-        return links
+        links = self._extra(payment).get("links", {})
+        # Older payments stored the full link objects under each rel
+        return {
+            rel: link["href"] if isinstance(link, dict) else link
+            for rel, link in links.items()
+        }
 
     def process_order(self, payment, request):
         success_url = payment.get_success_url()
@@ -191,12 +295,11 @@ class PaypalProvider(BasicProvider):
     def _get_access_token(self):
         headers = {"Accept": "application/json", "Accept-Language": "en_US"}
         post = {"grant_type": "client_credentials"}
-        response = requests.post(
+        response = self.session.post(
             self.oauth2_url,
             data=post,
             headers=headers,
             auth=(self.client_id, self.secret),
-            verify=not settings.DEBUG,
         )
         response.raise_for_status()
         data = response.json()
@@ -205,37 +308,39 @@ class PaypalProvider(BasicProvider):
     def get_api(self, url, params):
         access_token = self._get_access_token()
         headers = {"Content-Type": "application/json", "Authorization": access_token}
-        response = requests.get(
-            url, params=params, headers=headers, verify=not settings.DEBUG
-        )
+        response = self.session.get(url, params=params, headers=headers)
         return response.json()
 
-    def post_api(self, url, request_data, method="POST"):
+    def post_api(self, url, request_data, method="POST", request_id=None):
         access_token = self._get_access_token()
         headers = {
             "Content-Type": "application/json",
             "Authorization": access_token,
             "Prefer": "return=representation",
         }
-        response = requests.request(
-            method, url, json=request_data, headers=headers, verify=not settings.DEBUG
-        )
+        if request_id is not None:
+            # Stable idempotency key, a repeated call returns the
+            # original result instead of executing twice
+            headers["PayPal-Request-Id"] = request_id
+        response = self.session.request(method, url, json=request_data, headers=headers)
         try:
             data = response.json()
         except ValueError:
             data = {}
-        if 400 <= response.status_code <= 500:
+        if response.status_code >= 400:
+            # Retriable statuses already went through the adapter's backoff
             logger.debug(data)
             message = "Paypal error on {}".format(url)
+            extra = {
+                "status_code": response.status_code,
+                "paypal_debug_id": response.headers.get("Paypal-Debug-Id"),
+            }
             if response.status_code == 400:
-                error_data = response.json()
-                logger.warning(
-                    message,
-                    extra={"response": error_data, "status_code": response.status_code},
-                )
-                message = error_data.get("message", message)
+                extra["response"] = data
+                logger.warning(message, extra=extra)
+                message = data.get("message", message)
             else:
-                logger.warning(message, extra={"status_code": response.status_code})
+                logger.warning(message, extra=extra)
             raise ValueError(message)
         return data
 
@@ -244,23 +349,47 @@ class PaypalProvider(BasicProvider):
             return HttpResponse(status=400)
 
         try:
-            data = json.loads(request.body.decode("utf-8"))
-        except ValueError:
+            data = orjson.loads(request.body)
+        except orjson.JSONDecodeError:
             return HttpResponse(status=400)
 
+        if data.get("event_type") not in self._webhook_dispatch:
+            # Unsupported event, no need to verify or process
+            return HttpResponse(status=204)
+
         if not self.verify_webhook(request, data) and not settings.DEBUG:
             return HttpResponse(status=400)
         logger.info("Paypal webhook: %s", data)
-        method_name = data["event_type"].replace(".", "_").lower()
-        method = getattr(self, "webhook_%s" % method_name, None)
-        if method is None:
-            return HttpResponse(status=204)
 
-        method(request, data)
+        event_id = data.get("id")
+        dedup_key = None
+        if event_id:
+            dedup_key = "froide_payment:paypal_evt:{}".format(event_id)
+            if not cache.add(dedup_key, 1, timeout=86400):
+                # Paypal retries aggressively, skip duplicate deliveries
+                return HttpResponse(status=204)
+
+        from ..tasks import process_paypal_webhook
+
+        # The task retries with backoff on failure
+        try:
+            process_paypal_webhook.delay(data)
+        except Exception:
+            # Could not enqueue: release the dedup key so Paypal's
+            # redelivery is not rejected, and let it retry
+            if dedup_key:
+                cache.delete(dedup_key)
+            raise
 
         return HttpResponse(status=204)
 
-    def webhook_billing_subscription_activated(self, request, data):
+    def process_webhook_event(self, data):
+        method = self._webhook_dispatch.get(data["event_type"])
+        if method is None:
+            return
+        method(data)
+
+    def webhook_billing_subscription_activated(self, data):
         resource = data["resource"]
         sub_remote_reference = resource["id"]
         try:
@@ -269,15 +398,14 @@ class PaypalProvider(BasicProvider):
             )
         except Subscription.DoesNotExist:
             return
-        old_sub_status = subscription.active
-        subscription.active = True
-        subscription.save()
-        if old_sub_status != subscription.active:
+        if not subscription.active:
+            subscription.active = True
+            subscription.save(update_fields=["active"])
             subscription_activated.send(sender=subscription)
 
         logger.info("Paypal webhook subscription activated %s", subscription.id)
 
-    def webhook_billing_subscription_cancelled(self, request, data):
+    def webhook_billing_subscription_cancelled(self, data):
         resource = data["resource"]
         sub_remote_reference = resource["id"]
         try:
@@ -286,21 +414,28 @@ class PaypalProvider(BasicProvider):
             )
         except Subscription.DoesNotExist:
             return
-        old_sub_status = subscription.active
-        subscription.active = False
+        was_active = subscription.active
+        update_fields = []
+        if subscription.active:
+            subscription.active = False
+            update_fields.append("active")
         if not subscription.canceled:
             subscription.canceled = timezone.now()
-        subscription.save()
-        if old_sub_status != subscription.active:
+            update_fields.append("canceled")
+        if update_fields:
+            subscription.save(update_fields=update_fields)
+        if was_active:
             subscription_canceled.send(sender=subscription)
 
         logger.info("Paypal webhook subscription canceled %s", subscription.id)
 
-    def webhook_payment_capture_completed(self, request, data):
+    def webhook_payment_capture_completed(self, data):
         resource = data["resource"]
         invoide_id = resource["invoice_id"]
         try:
-            payment = Payment.objects.get(order__token=invoide_id)
+            payment = Payment.objects.select_related("order").get(
+                order__token=invoide_id
+            )
         except Payment.DoesNotExist:
             return
 
@@ -313,42 +448,53 @@ class PaypalProvider(BasicProvider):
             .get("value", "0.0")
         )
         payment.received_amount = Decimal(payment.total) - fee
-        payment.received_timestamp = dateutil.parser.parse(resource["create_time"])
+        payment.received_timestamp = _parse_iso(resource["create_time"])
+        payment.save(
+            update_fields=[
+                "extra_data",
+                "captured_amount",
+                "received_amount",
+                "received_timestamp",
+                "modified",
+            ]
+        )
         payment.change_status(PaymentStatus.CONFIRMED)
-        payment.save()
 
-    def webhook_payment_sale_completed(self, request, data):
+    def webhook_payment_sale_completed(self, data):
         resource = data["resource"]
         if "parent_payment" in resource:
             payment_reference = resource["parent_payment"]
             try:
-                payment = Payment.objects.get(transaction_id=payment_reference)
+                payment = Payment.objects.select_related("order").get(
+                    transaction_id=payment_reference
+                )
             except Payment.DoesNotExist:
                 return
         elif "billing_agreement_id" in resource:
             sub_reference = resource["billing_agreement_id"]
             try:
-                subscription = Subscription.objects.get(
-                    remote_reference=sub_reference, plan__provider=self.provider_name
-                )
+                subscription = Subscription.objects.select_related(
+                    "plan", "customer"
+                ).get(remote_reference=sub_reference, plan__provider=self.provider_name)
             except Subscription.DoesNotExist:
                 return
-            old_sub_status = subscription.active
-            subscription.active = True
-            subscription.save()
-
-            if old_sub_status != subscription.active:
-                if subscription.active:
-                    subscription_activated.send(sender=subscription)
-                else:
-                    subscription_deactivated.send(sender=subscription)
-
-            order = subscription.get_last_order()
+            if not subscription.active:
+                subscription.active = True
+                subscription.save(update_fields=["active"])
+                subscription_activated.send(sender=subscription)
+
+            order = (
+                subscription.orders.prefetch_related("payments")
+                .order_by("-service_end")
+                .first()
+            )
             soon = timezone.now() + timedelta(days=2)
-            if order.service_end < soon:
+            if order is None or order.service_end < soon:
                 payment = subscription.create_recurring_order(force=True)
             else:
-                payment = Payment.objects.get(order=order)
+                payment = next(iter(order.payments.all()), None)
+            if payment is None:
+                return
         else:
             return
 
@@ -357,11 +503,69 @@ class PaypalProvider(BasicProvider):
         payment.captured_amount = Decimal(payment.total)
         fee = Decimal(resource.get("transaction_fee", {}).get("value", "0.0"))
         payment.received_amount = Decimal(payment.total) - fee
-        payment.received_timestamp = dateutil.parser.parse(resource["create_time"])
+        payment.received_timestamp = _parse_iso(resource["create_time"])
+        payment.save(
+            update_fields=[
+                "extra_data",
+                "captured_amount",
+                "received_amount",
+                "received_timestamp",
+                "modified",
+            ]
+        )
         payment.change_status(PaymentStatus.CONFIRMED)
-        payment.save()
 
     def verify_webhook(self, request, data):
+        if getattr(settings, "PAYPAL_LOCAL_VERIFY", True):
+            try:
+                return self.verify_webhook_locally(request)
+            except Exception as e:
+                # Fall back to remote verification
+                logger.exception(e)
+        return self.verify_webhook_remotely(request, data)
+
+    def verify_webhook_locally(self, request):
+        """
+        Verify the webhook signature against Paypal's signing cert
+        without a round trip to the verification endpoint.
+        """
+        headers = request.headers
+        cert_url = headers.get("PAYPAL-CERT-URL", "")
+        # The signing cert must come from Paypal itself, check the
+        # parsed hostname, not a substring of the URL
+        cert_url_parts = urlsplit(cert_url)
+        cert_host = cert_url_parts.hostname or ""
+        if cert_url_parts.scheme != "https" or not (
+            cert_host == "paypal.com" or cert_host.endswith(".paypal.com")
+        ):
+            return False
+        if headers.get("PAYPAL-AUTH-ALGO", "") != "SHA256withRSA":
+            return False
+        message = "{transmission_id}|{transmission_time}|{webhook_id}|{crc}".format(
+            transmission_id=headers.get("PAYPAL-TRANSMISSION-ID", ""),
+            transmission_time=headers.get("PAYPAL-TRANSMISSION-TIME", ""),
+            webhook_id=self.webhook_id,
+            crc=binascii.crc32(request.body),
+        )
+        signature = base64.b64decode(headers.get("PAYPAL-TRANSMISSION-SIG", ""))
+        pem = cache.get_or_set(
+            "froide_payment:paypal_cert:{}".format(cert_url),
+            lambda: self._fetch_cert(cert_url),
+            60 * 60 * 24,
+        )
+        public_key = load_pem_x509_certificate(pem).public_key()
+        try:
+            public_key.verify(signature, message.encode(), PKCS1v15(), SHA256())
+        except InvalidSignature:
+            return False
+        return True
+
+    def _fetch_cert(self, cert_url):
+        response = self.session.get(cert_url)
+        response.raise_for_status()
+        return response.content
+
+    def verify_webhook_remotely(self, request, data):
         def get_header(key):
             return request.headers.get(key, "")
 
@@ -386,7 +590,7 @@ class PaypalProvider(BasicProvider):
         return redirect(payment.get_success_url())
 
     def update_payment(self, payment):
-        data = json.loads(payment.extra_data or "{}")
+        data = self._extra(payment)
         if data.get("response"):
             resource = data["response"]["transactions"][0]
             resource = resource["related_resources"][0]["sale"]
@@ -394,7 +598,7 @@ class PaypalProvider(BasicProvider):
             return
         else:
             resource = data["paypal_resource"]
-        create_time = dateutil.parser.parse(resource["create_time"])
+        create_time = _parse_iso(resource["create_time"])
         if not resource.get("amount") and not resource.get("response"):
             buffer = timedelta(days=2)
             start = create_time - buffer
@@ -406,14 +610,8 @@ class PaypalProvider(BasicProvider):
                 id=resource["id"], start=utcisoformat(start), end=utcisoformat(end)
             )
             result = self.get_api(url, {})
-            transactions = [
-                t
-                for t in result["transactions"]
-                if (
-                    dateutil.parser.parse(t["time"]) - buffer < create_time
-                    and dateutil.parser.parse(t["time"]) + buffer > create_time
-                )
-            ]
+            # The API already filters to the requested time window
+            transactions = result["transactions"]
             assert len(transactions) == 1
             transaction = transactions[0]
             payment.transaction_id = transaction["id"]
@@ -502,7 +700,11 @@ class PaypalProvider(BasicProvider):
             },
         }
         try:
-            response = self.post_api(capture_url, capture_data)
+            response = self.post_api(
+                capture_url,
+                capture_data,
+                request_id="{}:sub-capture".format(order.token),
+            )
         except ValueError:
             # can't capture
             return
@@ -551,19 +753,21 @@ class PaypalProvider(BasicProvider):
                 },
             }
             subscription_url = self.endpoint + "/v1/billing/subscriptions"
-            data = self.post_api(subscription_url, subscription_data)
+            data = self.post_api(
+                subscription_url,
+                subscription_data,
+                request_id="{}:subscribe".format(subscription.token),
+            )
             subscription.remote_reference = data["id"]
             subscription.save()
-            approve_urls = [
-                link["href"] for link in data["links"] if link["rel"] == "approve"
-            ]
-            if approve_urls:
-                raise RedirectNeeded(approve_urls[0])
+            approve_url = _index_links(data).get("approve")
+            if approve_url:
+                raise RedirectNeeded(approve_url)
 
     def get_or_create_product(self, category):
         try:
-            product = Product.objects.get(
-                category=category, provider=self.provider_name
+            return Product.objects.get(
+                pk=product_pk_lookup(category, self.provider_name)
             )
         except Product.DoesNotExist:
             home_url = settings.SITE_URL
@@ -590,11 +794,10 @@ class PaypalProvider(BasicProvider):
     def get_or_create_plan(self, plan_name, category, amount, month_interval):
         product = self.get_or_create_product(category)
         try:
-            plan = Plan.objects.get(
-                product=product,
-                amount=amount,
-                interval=month_interval,
-                provider=self.provider_name,
+            return Plan.objects.get(
+                pk=plan_pk_lookup(
+                    product.pk, amount, month_interval, self.provider_name
+                )
             )
         except Plan.DoesNotExist:
             plan_data = {
@@ -633,7 +836,7 @@ class PaypalProvider(BasicProvider):
                 category=category,
                 amount=amount,
                 interval=month_interval,
-                amount_year=amount * Decimal(12 / month_interval),
+                amount_year=amount * 12 / Decimal(month_interval),
                 provider=self.provider_name,
                 remote_reference=data["id"],
                 product=product,
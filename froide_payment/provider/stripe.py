@@ -1,15 +1,23 @@
-import json
+import hashlib
+import hmac
 import logging
+import time
+from collections import namedtuple
 from datetime import datetime
 from datetime import timezone as tz
 from decimal import Decimal
+from functools import lru_cache
 from typing import Optional
 
+import orjson
+import requests
 import stripe
+from requests.adapters import HTTPAdapter
 from django.conf import settings
+from django.core.cache import cache
 from django.core.mail import mail_managers
-from django.db import IntegrityError, transaction
-from django.http import HttpResponse, JsonResponse
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpResponse
 from django.shortcuts import redirect
 from django.utils import timezone
 from django.utils.text import slugify
@@ -30,20 +38,105 @@ from ..models import (
     Subscription,
 )
 from ..signals import (
-    sepa_notification,
     subscription_activated,
     subscription_canceled,
     subscription_created,
     subscription_deactivated,
 )
-from ..utils import send_sepa_mail
+from ..utils import json_response
+from .mixins import plan_pk_lookup, product_pk_lookup
 from .utils import CancelInfo, ModifyInfo
 
 logger = logging.getLogger(__name__)
 
+# Reuse one pooled HTTP session for all Stripe API calls and let the
+# SDK retry transient network errors itself
+_stripe_session = requests.Session()
+_stripe_session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=20, pool_maxsize=50),
+)
+stripe.default_http_client = stripe.http_client.RequestsClient(
+    timeout=10, session=_stripe_session
+)
+# Retries stay with the SDK, which knows which calls are idempotent
+stripe.max_network_retries = 2
+
+
+# Balance transactions are immutable once settled, only these two
+# fields are ever read from them
+BalanceTxn = namedtuple("BalanceTxn", ("net", "created"))
+
+
+def money_from_cents(cents):
+    # Stripe reports integer cents; shifting the exponent is cheaper
+    # than Decimal division or multiplication
+    return Decimal(cents).scaleb(-2)
+
+
+INTENT_CACHE_TTL = 30
+
+
+def retrieve_cached(api_resource, tn_id, expand=None):
+    """Retrieve a Stripe object, absorbing reload storms with a short
+    cache. Webhook handlers invalidate on status transitions."""
+    key = "froide_payment:stripe:obj:{}".format(tn_id)
+    if expand:
+        # Expanded variants cache separately from the plain object
+        key = "{}:{}".format(key, ",".join(expand))
+    raw = cache.get(key)
+    if raw is not None:
+        return api_resource.construct_from(orjson.loads(raw), stripe.api_key)
+    if expand:
+        obj = api_resource.retrieve(tn_id, expand=expand)
+    else:
+        obj = api_resource.retrieve(tn_id)
+    cache.set(key, orjson.dumps(obj, default=str), INTENT_CACHE_TTL)
+    return obj
+
+
+def invalidate_cached_object(tn_id):
+    cache.delete("froide_payment:stripe:obj:{}".format(tn_id))
+
+
+def provider_creation_lock(name):
+    """Serialize remote-resource creation on a Postgres advisory lock,
+    so concurrent signups cannot create duplicate Stripe objects."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [name])
+
 
+def make_idempotency_key(*parts):
+    """Derive a stable Stripe idempotency key for one logical write, so
+    form-submit retries replay the prior response instead of creating
+    duplicate remote resources."""
+    raw = ":".join(str(part) for part in parts)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def trim_charges(charges):
+    # Persist a small projection instead of the full charge objects,
+    # expanded balance transactions collapse back to their id
+    return [
+        {
+            "id": charge.id,
+            "amount": charge.amount,
+            "status": charge.status,
+            "balance_transaction": (
+                charge.balance_transaction.id
+                if not isinstance(charge.balance_transaction, (str, type(None)))
+                else charge.balance_transaction
+            ),
+        }
+        for charge in charges
+    ]
+
+
+@lru_cache(maxsize=4096)
 def convert_utc_timestamp(timestamp):
-    return datetime.utcfromtimestamp(timestamp).replace(tzinfo=tz.utc)
+    # Pure int -> aware datetime mapping, repeated timestamps within a
+    # webhook batch hit the cache
+    return datetime.fromtimestamp(timestamp, tz=tz.utc)
 
 
 def requires_confirmation(request, payment, data) -> bool:
@@ -75,34 +168,94 @@ def _requires_confirmation(request, payment, data) -> Optional[str]:
 class StripeWebhookMixin:
     def __init__(self, **kwargs):
         self.signing_secret = kwargs.pop("signing_secret", "")
+        # Pre-initialize the HMAC key schedule, verification then only
+        # needs a cheap copy() per webhook
+        self._hmac_prototype = hmac.new(
+            self.signing_secret.encode(), b"", hashlib.sha256
+        )
         super().__init__(**kwargs)
 
-    def decode_webhook_request(self, request):
-        payload = request.body
-        sig_header = request.META.get("HTTP_STRIPE_SIGNATURE")
-        event = None
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Each provider class gets its own lazily filled dispatch table
+        cls._webhook_dispatch = {}
 
+    def _get_webhook_method(self, event_type):
+        cls = type(self)
         try:
-            event = stripe.Webhook.construct_event(
-                payload, sig_header, self.signing_secret
-            )
+            return cls._webhook_dispatch[event_type]
+        except KeyError:
+            method = getattr(cls, event_type.replace(".", "_"), None)
+            cls._webhook_dispatch[event_type] = method
+            return method
+
+    # Real Stripe webhook payloads stay well below this
+    MAX_WEBHOOK_SIZE = 64 * 1024
+
+    def _verify_signature(self, payload, sig_header):
+        # Cheap shape checks before any HMAC work, webhook endpoints
+        # see plenty of junk probe traffic
+        if not sig_header or "t=" not in sig_header or "v1=" not in sig_header:
+            return False
+        if len(payload) > self.MAX_WEBHOOK_SIZE:
+            return False
+        timestamp = None
+        signatures = []
+        for item in sig_header.split(","):
+            key, _, value = item.strip().partition("=")
+            if key == "t":
+                timestamp = value
+            elif key == "v1":
+                signatures.append(value)
+        if timestamp is None or not signatures:
+            return False
+        try:
+            if abs(time.time() - int(timestamp)) > stripe.Webhook.DEFAULT_TOLERANCE:
+                return False
         except ValueError:
+            return False
+        mac = self._hmac_prototype.copy()
+        mac.update(timestamp.encode())
+        mac.update(b".")
+        mac.update(payload if isinstance(payload, bytes) else payload.encode())
+        expected = mac.hexdigest()
+        return any(hmac.compare_digest(expected, sig) for sig in signatures)
+
+    def decode_webhook_request(self, request):
+        # get_token_from_request already verified and decoded the event
+        cached = getattr(request, "_stripe_event", None)
+        if cached is not None:
+            return cached
+        payload = request.body
+        sig_header = request.META.get("HTTP_STRIPE_SIGNATURE")
+        if not self._verify_signature(payload, sig_header):
             return None
-        except stripe.error.SignatureVerificationError:
+        try:
+            data = orjson.loads(payload)
+        except orjson.JSONDecodeError:
             return None
-        return event.to_dict()
+        # Keep the plain dict, the worker task reconstructs the
+        # StripeObject when handling the event
+        request._stripe_event = data
+        return data
 
     def get_token_from_request(self, request=None, payment=None):
         """
         Extract payment token from webhook
         via payment intent's id == payment.transaction_id
         """
-        event_dict = self.decode_webhook_request(request)
-        if event_dict is None:
+        payload = request.body
+        sig_header = request.META.get("HTTP_STRIPE_SIGNATURE")
+        if not self._verify_signature(payload, sig_header):
+            return None
+        try:
+            raw = orjson.loads(payload)
+        except orjson.JSONDecodeError:
             return None
-        obj = event_dict["data"]["object"]
+        obj = raw.get("data", {}).get("object", {})
 
         # Check if this provider handles this callback
+        # before materializing the full event object
         payment_method_details = obj.get("payment_method_details", None)
         if payment_method_details:
             payment_method_type = payment_method_details.get("type")
@@ -111,15 +264,27 @@ class StripeWebhookMixin:
         else:
             return False
 
-        payment = self.get_payment_by_id(obj["id"])
-        if payment is None:
-            return None
-        return payment.token
+        # Cache for handle_webhook, the webhook was decoded twice before
+        request._stripe_event = raw
+
+        return self.get_payment_token_by_id(obj["id"])
+
+    def get_payment_token_by_id(self, transaction_id):
+        # Only the token is needed here, skip loading the wide
+        # payment row with its extra_data blob
+        Payment = get_payment_model()
+        return (
+            Payment.objects.filter(transaction_id=transaction_id)
+            .values_list("token", flat=True)
+            .first()
+        )
 
     def get_payment_by_id(self, transaction_id):
         Payment = get_payment_model()
         try:
-            return Payment.objects.get(
+            return Payment.objects.select_related(
+                "order", "order__subscription", "order__subscription__plan"
+            ).get(
                 transaction_id=transaction_id,
             )
         except Payment.DoesNotExist:
@@ -128,11 +293,16 @@ class StripeWebhookMixin:
     def get_balance_transaction(self, txn_id):
         if not txn_id:
             return None
+        cache_key = "froide_payment:stripe:bt:{}".format(txn_id)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return BalanceTxn(*cached)
         try:
             bt = stripe.BalanceTransaction.retrieve(txn_id)
         except stripe.error.StripeError:
             return None
-        return bt
+        cache.set(cache_key, (bt.net, bt.created), 86400 * 7)
+        return BalanceTxn(bt.net, bt.created)
 
     def process_data(self, payment, request):
         if payment.variant != self.provider_name:
@@ -146,18 +316,42 @@ class StripeWebhookMixin:
             # Webhook likely not for this endpoint (failed due to signing key)
             return HttpResponse(status=204)
         event_type = event_dict["type"]
-        obj = event_dict["data"]["object"]
-
-        method_name = event_type.replace(".", "_")
-        method = getattr(self, method_name, None)
-        if method is None:
+        if self._get_webhook_method(event_type) is None:
             return HttpResponse(status=204)
 
-        result = method(request, obj)
-        if result is not None:
-            return result
+        event_id = event_dict.get("id")
+        dedup_key = None
+        if event_id:
+            # Stripe redelivers events, only enqueue the first sighting
+            dedup_key = "froide_payment:stripe_evt:{}".format(event_id)
+            if not cache.add(dedup_key, 1, 86400):
+                return HttpResponse(status=200)
 
-        return HttpResponse(status=201)
+        from ..tasks import process_stripe_event
+
+        # Acknowledge the webhook right away, Stripe retries on
+        # slow responses; the actual processing happens in a task,
+        # which retries with backoff on failure
+        try:
+            process_stripe_event.delay(self.provider_name, event_dict)
+        except Exception:
+            # Could not enqueue: release the dedup key so Stripe's
+            # redelivery is not rejected, and let it retry
+            if dedup_key:
+                cache.delete(dedup_key)
+            raise
+
+        return HttpResponse(status=200)
+
+    def process_webhook_event(self, event_dict):
+        event = stripe.Event.construct_from(event_dict, stripe.api_key)
+        method = self._get_webhook_method(event.type)
+        if method is None:
+            return
+        # One commit per event instead of one per save, and a clean
+        # rollback if a handler fails halfway
+        with transaction.atomic():
+            method(self, None, event.data.object)
 
 
 class StripeSubscriptionMixin:
@@ -212,7 +406,7 @@ class StripeSubscriptionMixin:
             logger.exception(e)
             return False
         subscription.plan = new_plan
-        subscription.save()
+        subscription.save(update_fields=["plan"])
         return True
 
     def get_stripe_locales(self):
@@ -237,13 +431,20 @@ class StripeSubscriptionMixin:
                 name=customer.get_full_name(),
                 preferred_locales=self.get_stripe_locales(),
                 metadata={"customer_id": customer.id},
+                idempotency_key=make_idempotency_key(
+                    "customer", customer.id, payment_method
+                ),
                 **pm_kwargs,
             )
             customer.remote_reference = stripe_customer.id
-            customer.save()
+            customer.save(update_fields=["remote_reference"])
         elif payment_method:
             stripe.PaymentMethod.attach(
-                payment_method, customer=customer.remote_reference
+                payment_method,
+                customer=customer.remote_reference,
+                idempotency_key=make_idempotency_key(
+                    "attach", customer.remote_reference, payment_method
+                ),
             )
             stripe.Customer.modify(
                 customer.remote_reference,
@@ -254,10 +455,20 @@ class StripeSubscriptionMixin:
 
     def get_or_create_product(self, category):
         try:
-            product = Product.objects.get(
-                category=category, provider=self.provider_name
+            return Product.objects.get(
+                pk=product_pk_lookup(category, self.provider_name)
             )
         except Product.DoesNotExist:
+            pass
+        with transaction.atomic():
+            provider_creation_lock("product:{}:{}".format(self.provider_name, category))
+            # Re-check under the lock, a concurrent signup may have
+            # created the product while we waited
+            product = Product.objects.filter(
+                category=category, provider=self.provider_name
+            ).first()
+            if product is not None:
+                return product
             stripe_product = stripe.Product.create(name=category, type="service")
             product = Product.objects.create(
                 name="{provider} {category}".format(
@@ -272,13 +483,27 @@ class StripeSubscriptionMixin:
     def get_or_create_plan(self, plan_name, category, amount, month_interval):
         product = self.get_or_create_product(category)
         try:
-            plan = Plan.objects.get(
+            return Plan.objects.get(
+                pk=plan_pk_lookup(
+                    product.pk, amount, month_interval, self.provider_name
+                )
+            )
+        except Plan.DoesNotExist:
+            pass
+        with transaction.atomic():
+            provider_creation_lock(
+                "plan:{}:{}:{}:{}".format(
+                    self.provider_name, product.pk, amount, month_interval
+                )
+            )
+            plan = Plan.objects.filter(
                 product=product,
                 amount=amount,
                 interval=month_interval,
                 provider=self.provider_name,
-            )
-        except Plan.DoesNotExist:
+            ).first()
+            if plan is not None:
+                return plan
             stripe_plan = stripe.Plan.create(
                 amount=int(amount * 100),  # Stripe takes cents
                 currency=settings.DEFAULT_CURRENCY.lower(),
@@ -293,7 +518,7 @@ class StripeSubscriptionMixin:
                 category=category,
                 amount=amount,
                 interval=month_interval,
-                amount_year=amount * Decimal(12 / month_interval),
+                amount_year=amount * 12 / Decimal(month_interval),
                 provider=self.provider_name,
                 remote_reference=stripe_plan.id,
                 product=product,
@@ -301,8 +526,15 @@ class StripeSubscriptionMixin:
         return plan
 
 
+_SITE_NAME = None
+
+
 def get_statement_descriptor(payment):
-    return "{} {}".format(settings.SITE_NAME, payment.order.id)
+    global _SITE_NAME
+    if _SITE_NAME is None:
+        _SITE_NAME = settings.SITE_NAME
+    # Use the FK id directly, payment.order may not be loaded
+    return f"{_SITE_NAME} {payment.order_id}"
 
 
 class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripeProvider):
@@ -312,11 +544,14 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
 
     def get_received_amount_timestamp(self, charges):
         for charge in charges:
-            txn = self.get_balance_transaction(charge.balance_transaction)
+            txn = charge.balance_transaction
+            if isinstance(txn, str):
+                # Not expanded at fetch time, needs an extra API call
+                txn = self.get_balance_transaction(txn)
             if txn is not None:
                 # Ignore refund fees
                 if txn.net > 0:
-                    return Decimal(txn.net) / 100, convert_utc_timestamp(txn.created)
+                    return money_from_cents(txn.net), convert_utc_timestamp(txn.created)
 
     def update_status(self, payment):
         if payment.status not in (PaymentStatus.PENDING, PaymentStatus.INPUT):
@@ -324,43 +559,50 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
         if not payment.transaction_id:
             return
         try:
-            intent = stripe.PaymentIntent.retrieve(payment.transaction_id)
+            intent = retrieve_cached(stripe.PaymentIntent, payment.transaction_id)
         except stripe.error.InvalidRequestError:
             # intent is not yet available
             return
 
-        charges = stripe.Charge.list(payment_intent=payment.transaction_id).data
-        payment.attrs.charges = charges
-        payment.captured_amount = Decimal(intent.amount_received) / 100
+        charges = stripe.Charge.list(
+            payment_intent=payment.transaction_id,
+            expand=["data.balance_transaction"],
+        ).data
+        payment.attrs.charges = trim_charges(charges)
+        payment.captured_amount = money_from_cents(intent.amount_received)
         received = self.get_received_amount_timestamp(charges)
         if received:
             payment.received_amount = received[0]
             payment.received_timestamp = received[1]
 
+        update_fields = [
+            "extra_data",
+            "captured_amount",
+            "received_amount",
+            "received_timestamp",
+        ]
         if intent.status == "succeeded":
-            payment.change_status(PaymentStatus.CONFIRMED)
-            payment.save()
+            payment.change_status_with_fields(PaymentStatus.CONFIRMED, update_fields)
             return True
         elif intent.status in ("failed", "requires_payment_method"):
             error_message = None
             if intent.get("last_payment_error"):
                 error_message = intent["last_payment_error"]["message"]
-            payment.change_status(PaymentStatus.ERROR, message=error_message)
-            payment.save()
+            payment.change_status_with_fields(
+                PaymentStatus.ERROR, update_fields, message=error_message or ""
+            )
             return False
         elif intent.status == "canceled":
-            payment.change_status(PaymentStatus.CANCELED)
-            payment.save()
+            payment.change_status_with_fields(PaymentStatus.CANCELED, update_fields)
             return False
         elif intent.status == "requires_confirmation":
             # Try confirming
             if payment.status == PaymentStatus.PENDING:
                 self.confirm_single_payment(payment)
             return False
+        payment.save(update_fields=update_fields + ["modified"])
         if payment.status != PaymentStatus.PENDING:
             payment.change_status(PaymentStatus.PENDING)
-
-        payment.save()
         return False
 
     def process_data(self, payment, request):
@@ -373,32 +615,32 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
 
     def handle_form_communication(self, payment, request):
         try:
-            data = json.loads(request.body.decode("utf-8"))
-        except ValueError:
-            return JsonResponse({"error": ""})
+            data = orjson.loads(request.body)
+        except orjson.JSONDecodeError:
+            return json_response({"error": ""})
         try:
             intent = self.handle_form_method(payment, data, request=request)
         except stripe.error.StripeError as e:
             # Display error on client
             logger.exception(e)
-            return JsonResponse({"error": e.user_message})
+            return json_response({"error": e.user_message})
         except ValueError as e:
             logger.exception(e)
-            return JsonResponse({"error": str(e)})
+            return json_response({"error": str(e)})
         if intent is True:
-            return JsonResponse({"success": True})
+            return json_response({"success": True})
         return self.generate_intent_response(intent)
 
     def generate_intent_response(self, intent):
         if intent.status == "requires_action":
-            return JsonResponse(
+            return json_response(
                 {
                     "requires_action": True,
                     "payment_intent_client_secret": intent.client_secret,
                 }
             )
         elif intent.status == "requires_confirmation":
-            return JsonResponse(
+            return json_response(
                 {
                     "requires_confirmation": True,
                     "type": intent.object,
@@ -414,8 +656,8 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
         elif intent.status == "succeeded":
             # The payment didn’t need any additional actions and completed!
             # Handle post-payment fulfillment
-            return JsonResponse({"success": True})
-        return JsonResponse({"error": "Invalid PaymentIntent status"})
+            return json_response({"success": True})
+        return json_response({"error": "Invalid PaymentIntent status"})
 
     def handle_form_method(self, payment, data, request=None):
         intent = None
@@ -433,7 +675,7 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
             )
         else:
             intent = stripe.PaymentIntent.create(
-                amount=int(payment.total * 100),
+                amount=payment.amount_cents,
                 currency=payment.currency,
                 payment_method_types=[self.stripe_payment_method_type],
                 use_stripe_sdk=True,
@@ -444,13 +686,12 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
             )
 
         payment.transaction_id = intent.id
-        payment.save()
+        payment.save(update_fields=["transaction_id", "modified"])
         return intent
 
     def get_form(self, payment, data=None):
         if payment.status == PaymentStatus.WAITING:
             payment.change_status(PaymentStatus.INPUT)
-            payment.save()
 
         form = self.form_class(data=data, payment=payment, provider=self)
         if data is not None:
@@ -462,7 +703,6 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
 
         if intent and intent.status == "succeeded":
             payment.change_status(PaymentStatus.CONFIRMED)
-            payment.save()
             raise RedirectNeeded(payment.get_success_url())
 
         if intent:
@@ -478,9 +718,9 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
 
         if payment.transaction_id:
             if order.is_recurring:
-                return stripe.SetupIntent.retrieve(payment.transaction_id)
+                return retrieve_cached(stripe.SetupIntent, payment.transaction_id)
             else:
-                return stripe.PaymentIntent.retrieve(payment.transaction_id)
+                return retrieve_cached(stripe.PaymentIntent, payment.transaction_id)
 
         kwargs = {}
         order = payment.order
@@ -496,7 +736,7 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
         else:
             # For non-recurring orders create payment intent directly
             intent = stripe.PaymentIntent.create(
-                amount=int(payment.total * 100),
+                amount=payment.amount_cents,
                 currency=payment.currency,
                 payment_method_types=[self.stripe_payment_method_type],
                 use_stripe_sdk=True,
@@ -505,7 +745,7 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
                 **kwargs,
             )
         payment.transaction_id = intent.id
-        payment.save()
+        payment.save(update_fields=["transaction_id", "modified"])
 
         return intent
 
@@ -534,6 +774,9 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
                     },
                 ],
                 expand=["latest_invoice", "latest_invoice.payment_intent"],
+                idempotency_key=make_idempotency_key(
+                    "subscription", subscription.id, payment_method
+                ),
             )
         else:
             stripe_subscription = stripe.Subscription.retrieve(
@@ -557,85 +800,118 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
             subscription.active = True
         else:
             subscription.active = False
-        subscription.save()
+        latest_invoice = stripe_subscription.latest_invoice
+        with transaction.atomic():
+            subscription.save(update_fields=["remote_reference", "active"])
+            subscription.attach_order_info(
+                remote_reference=latest_invoice.id,
+            )
         if old_sub_status != subscription.active:
             if subscription.active:
                 subscription_activated.send(sender=subscription)
             else:
                 subscription_deactivated.send(sender=subscription)
-
-        latest_invoice = stripe_subscription.latest_invoice
-        subscription.attach_order_info(
-            remote_reference=latest_invoice.id,
-        )
         payment_intent = stripe_subscription.latest_invoice.payment_intent
         return payment_intent
 
     def update_payment(self, payment):
         tn_id = payment.transaction_id
-        assert tn_id.startswith("pi_")
-        intent = stripe.PaymentIntent.retrieve(tn_id)
-        payment.captured_amount = Decimal(intent.amount_received) / 100
-
-        charges = stripe.Charge.list(payment_intent=tn_id).data
-        payment.attrs.charges = charges
+        if not tn_id.startswith("pi_"):
+            raise ValueError("Unexpected transaction id %r" % tn_id)
+        intent = retrieve_cached(stripe.PaymentIntent, tn_id)
+        payment.captured_amount = money_from_cents(intent.amount_received)
+
+        charges = stripe.Charge.list(
+            payment_intent=tn_id, expand=["data.balance_transaction"]
+        ).data
+        payment.attrs.charges = trim_charges(charges)
         received = self.get_received_amount_timestamp(charges)
         if received:
             payment.received_amount = received[0]
             payment.received_timestamp = received[1]
 
+        payment.save(
+            update_fields=[
+                "captured_amount",
+                "extra_data",
+                "received_amount",
+                "received_timestamp",
+                "modified",
+            ]
+        )
         if intent.status == "succeeded":
             payment.change_status(PaymentStatus.CONFIRMED)
-        payment.save()
 
     def get_or_create_order_from_invoice(self, invoice):
-        try:
-            return Order.objects.get(remote_reference=invoice.id)
-        except Order.DoesNotExist:
-            pass
-        subscription = Subscription.objects.get(
-            remote_reference=invoice.subscription, plan__provider=self.provider_name
+        existing = Order.objects.filter(remote_reference=invoice.id).only("id").first()
+        if existing is not None:
+            return existing
+        subscription = Subscription.objects.select_related(
+            "customer", "customer__user", "plan"
+        ).get(remote_reference=invoice.subscription, plan__provider=self.provider_name)
+        first_order = (
+            subscription.orders.only("is_donation", "kind", "description")
+            .order_by("service_end")
+            .first()
         )
-        first_order = subscription.get_first_order()
         customer = subscription.customer
         start_dt = convert_utc_timestamp(invoice.period_start)
         end_dt = convert_utc_timestamp(invoice.period_end)
-        order = Order.objects.create(
-            customer=customer,
-            subscription=subscription,
-            user=customer.user,
-            first_name=customer.first_name,
-            last_name=customer.last_name,
-            street_address_1=customer.street_address_1,
-            street_address_2=customer.street_address_2,
-            city=customer.city,
-            postcode=customer.postcode,
-            country=customer.country,
-            user_email=customer.user_email,
-            total_net=subscription.plan.amount,
-            total_gross=subscription.plan.amount,
-            is_donation=first_order.is_donation,
-            kind=first_order.kind,
-            description=first_order.description,
-            service_start=start_dt,
-            service_end=end_dt,
+        order, created = Order.objects.get_or_create(
             remote_reference=invoice.id,
+            defaults={
+                "customer": customer,
+                "subscription": subscription,
+                "user": customer.user,
+                "first_name": customer.first_name,
+                "last_name": customer.last_name,
+                "street_address_1": customer.street_address_1,
+                "street_address_2": customer.street_address_2,
+                "city": customer.city,
+                "postcode": customer.postcode,
+                "country": customer.country,
+                "user_email": customer.user_email,
+                "total_net": subscription.plan.amount,
+                "total_gross": subscription.plan.amount,
+                "is_donation": first_order.is_donation,
+                "kind": first_order.kind,
+                "description": first_order.description,
+                "service_start": start_dt,
+                "service_end": end_dt,
+            },
         )
+        if not created:
+            # A concurrent webhook delivery created the order already
+            return order
         payment = order.get_or_create_payment(self.provider_name)
         payment.transaction_id = invoice.charge
-        intent = stripe.PaymentIntent.retrieve(invoice.payment_intent)
-        payment.captured_amount = Decimal(intent.amount_received) / 100
-
-        charges = stripe.Charge.list(payment_intent=intent.id).data
-        payment.attrs.charges = charges
+        intent = invoice.payment_intent
+        if isinstance(intent, str):
+            # Not expanded in the webhook payload, fetch it
+            intent = retrieve_cached(stripe.PaymentIntent, intent)
+        payment.captured_amount = money_from_cents(intent.amount_received)
+
+        charges = stripe.Charge.list(
+            payment_intent=intent.id, expand=["data.balance_transaction"]
+        ).data
+        payment.attrs.charges = trim_charges(charges)
         received = self.get_received_amount_timestamp(charges)
         if received:
             payment.received_amount = received[0]
             payment.received_timestamp = received[1]
 
+        payment.save(
+            update_fields=[
+                "transaction_id",
+                "captured_amount",
+                "extra_data",
+                "received_amount",
+                "received_timestamp",
+                "modified",
+            ]
+        )
         if invoice.status == "paid":
             payment.change_status(PaymentStatus.CONFIRMED)
-        payment.save()
 
     # Webhook callbacks
 
@@ -644,6 +920,7 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
             "%s Webhook: Payment intent succeeded: %s", self.provider_name, intent.id
         )
 
+        invalidate_cached_object(intent.id)
         payment = self.get_payment_by_id(intent.id)
         if payment is None:
             return
@@ -654,6 +931,7 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
             "%s Webhook: Payment intent failed: %s", self.provider_name, intent.id
         )
 
+        invalidate_cached_object(intent.id)
         payment = self.get_payment_by_id(intent.id)
         if payment is None:
             return
@@ -665,6 +943,7 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
             "%s Webhook: Payment intent canceled: %s", self.provider_name, intent.id
         )
 
+        invalidate_cached_object(intent.id)
         payment = self.get_payment_by_id(intent.id)
         if payment is None:
             return
@@ -677,41 +956,59 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
         pass
 
     def get_payment_for_invoice(self, invoice_id):
-        invoice = stripe.Invoice.retrieve(invoice_id)
+        invoice = retrieve_cached(stripe.Invoice, invoice_id)
+        # Stripe retries unknown invoices aggressively, keep a short
+        # negative cache to avoid a DB hit per retry
+        cache_key = "froide_payment:unknown_sub:{}:{}".format(
+            self.provider_name, invoice.subscription
+        )
+        if cache.get(cache_key):
+            return
         try:
-            subscription = Subscription.objects.get(
-                remote_reference=invoice.subscription, plan__provider=self.provider_name
+            subscription = Subscription.objects.select_related(
+                "customer__user", "plan"
+            ).get(
+                remote_reference=invoice.subscription,
+                plan__provider=self.provider_name,
             )
         except Subscription.DoesNotExist:
             # Don't know this subscription on this provider
+            cache.set(cache_key, True, 60)
             return
 
-        tries = 0
-        while tries < 4:
-            orders = Order.objects.filter(remote_reference=invoice_id)
+        payment = None
+        order = (
+            Order.objects.filter(remote_reference=invoice_id)
+            .prefetch_related("payments")
+            .first()
+        )
+        if order is None:
             try:
                 with transaction.atomic():
-                    payment = None
-                    order = orders.first()
-                    if order is None:
-                        # Create order based on invoice
-                        payment = subscription.create_recurring_order(
-                            remote_reference=invoice_id, remote_reference_is_unique=True
-                        )
-                    else:
-                        payment = order.payments.all()[0]
-
-                    if payment is None:
-                        tries += 1
-                        continue
-
-                    if invoice.payment_intent and not payment.transaction_id:
-                        payment.transaction_id = invoice.payment_intent
-                        payment.save(update_fields=["transaction_id"])
-                    return payment
+                    # Create order based on invoice, the unique
+                    # constraint on remote_reference arbitrates
+                    # concurrent webhook workers
+                    payment = subscription.create_recurring_order(
+                        remote_reference=invoice_id, remote_reference_is_unique=True
+                    )
             except IntegrityError:
-                pass
-            tries += 1
+                # Another worker created the order first, use theirs
+                order = (
+                    Order.objects.filter(remote_reference=invoice_id)
+                    .prefetch_related("payments")
+                    .first()
+                )
+        if payment is None:
+            if order is None:
+                return
+            payment = next(iter(order.payments.all()), None)
+            if payment is None:
+                return
+
+        if invoice.payment_intent and not payment.transaction_id:
+            payment.transaction_id = invoice.payment_intent
+            payment.save(update_fields=["transaction_id", "modified"])
+        return payment
 
     def invoice_updated(self, request, invoice):
         payment = self.get_payment_for_invoice(invoice.id)
@@ -757,17 +1054,27 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
             return
         mail_managers("Charge dispute lost", str(dispute))
         try:
-            payment = Payment.objects.get(
-                transaction_id=dispute["payment_intent"], variant=self.provider_name
-            )
+            # Narrow fetch, only the columns written below plus token,
+            # which the base save() checks
+            payment = Payment.objects.only(
+                "id",
+                "token",
+                "status",
+                "message",
+                "captured_amount",
+                "received_amount",
+                "received_timestamp",
+            ).get(transaction_id=dispute["payment_intent"], variant=self.provider_name)
         except Payment.DoesNotExist:
             logger.warning("Could not find payment for lost dispute %s", dispute["id"])
             return
         payment.captured_amount = Decimal("0.0")
         payment.received_amount = Decimal("0.0")
         payment.received_timestamp = None
-        payment.change_status(PaymentStatus.REJECTED)
-        payment.save()
+        payment.change_status_with_fields(
+            PaymentStatus.REJECTED,
+            ["captured_amount", "received_amount", "received_timestamp"],
+        )
 
     def confirm_single_payment(self, payment):
         """
@@ -800,7 +1107,6 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
             },
         )
         payment.change_status(PaymentStatus.PENDING)
-        payment.save()
 
     def customer_subscription_created(
         self, request, stripe_subscription: stripe.Subscription
@@ -823,12 +1129,14 @@ class StripeIntentProvider(StripeSubscriptionMixin, StripeWebhookMixin, StripePr
     def customer_subscription_deleted(
         self, request, stripe_subscription: stripe.Subscription
     ):
-        sub = Subscription.objects.get(remote_reference=stripe_subscription.id)
+        sub = Subscription.objects.select_related("customer", "plan").get(
+            remote_reference=stripe_subscription.id
+        )
         sub.active = False
         sub.canceled = datetime.fromtimestamp(
             stripe_subscription.canceled_at, tz=timezone.utc
         )
-        sub.save()
+        sub.save(update_fields=["active", "canceled"])
         subscription_canceled.send(sender=sub)
 
 
@@ -847,9 +1155,9 @@ class StripeSEPAProvider(StripeIntentProvider):
         intent = None
         if payment.transaction_id:
             if payment.transaction_id.startswith(self.stripe_setup_intent_prefix):
-                intent = stripe.SetupIntent.retrieve(payment.transaction_id)
+                intent = retrieve_cached(stripe.SetupIntent, payment.transaction_id)
             else:
-                intent = stripe.PaymentIntent.retrieve(payment.transaction_id)
+                intent = retrieve_cached(stripe.PaymentIntent, payment.transaction_id)
         return intent
 
     def confirm_payment(self, payment):
@@ -875,8 +1183,8 @@ class StripeSEPAProvider(StripeIntentProvider):
             )
             payment_intent = stripe_subscription.latest_invoice.payment_intent
             payment.transaction_id = payment_intent.id
+            payment.save(update_fields=["transaction_id", "modified"])
             payment.change_status(PaymentStatus.PENDING)
-            payment.save()
             return
 
         self.confirm_single_payment(payment)
@@ -900,7 +1208,6 @@ class StripeSEPAProvider(StripeIntentProvider):
         except stripe.error.StripeError as e:
             logger.exception(e)
         payment.change_status(PaymentStatus.CANCELED)
-        payment.save()
 
     def handle_form_method(self, payment, data, request=None):
         if "iban" in data:
@@ -924,7 +1231,7 @@ class StripeSEPAProvider(StripeIntentProvider):
                 payment.modified = timezone.now()
                 payment.attrs.needs_confirmation = needs_confirmation
                 payment.attrs.user_agent = request.META.get("HTTP_USER_AGENT", "")
-                payment.save()
+                payment.save(update_fields=["modified", "extra_data"])
 
                 return intent
             raise ValueError(" ".join(" ".join(v) for v in form.errors.values()))
@@ -934,7 +1241,6 @@ class StripeSEPAProvider(StripeIntentProvider):
                     payment.change_status(PaymentStatus.DEFERRED)
                 else:
                     payment.change_status(PaymentStatus.PENDING)
-                payment.save()
             return True
         return None
 
@@ -986,11 +1292,21 @@ class StripeSEPAProvider(StripeIntentProvider):
             return HttpResponse(status=204)
 
         subscription = order.subscription
-        first_order = subscription.get_first_order()
-        if order == first_order:
+        is_first_order = not subscription.orders.filter(
+            service_end__lt=order.service_end
+        ).exists()
+        if is_first_order:
             # Only need to send notification for recurring debits
             return HttpResponse(status=204)
 
+        try:
+            if payment.attrs.last4:
+                # Redelivered event, the notification went out already
+                return HttpResponse(status=204)
+        except AttributeError:
+            pass
+
+        customer = order.customer
         charges = stripe.Charge.list(payment_intent=intent.id).data
         data = None
         for charge in charges:
@@ -1000,11 +1316,20 @@ class StripeSEPAProvider(StripeIntentProvider):
                 # implementation endpoint
                 return HttpResponse(status=204)
             sepa_debit = charge.payment_method_details.sepa_debit
-            mandate_id = sepa_debit.mandate
-            mandate = stripe.Mandate.retrieve(mandate_id)
-            mandate.payment_method_details.sepa_debit.reference
-            mandate_sepa_debit = mandate.payment_method_details.sepa_debit
-            mandate_reference = mandate_sepa_debit.reference
+            # The mandate reference is stable per customer, prefer the
+            # locally stored copy over a Mandate.retrieve round trip
+            mandate_reference = None
+            if customer is not None:
+                mandate_reference = customer.data.get("mandats_id")
+            if not mandate_reference:
+                mandate = stripe.Mandate.retrieve(sepa_debit.mandate)
+                mandate_sepa_debit = mandate.payment_method_details.sepa_debit
+                mandate_reference = mandate_sepa_debit.reference
+                if customer is not None:
+                    customer_data = customer.data
+                    customer_data["mandats_id"] = mandate_reference
+                    customer.custom_data = orjson.dumps(customer_data).decode()
+                    customer.save(update_fields=["custom_data"])
             data = {
                 "last4": sepa_debit.last4,
                 "mandate_reference": mandate_reference,
@@ -1014,10 +1339,15 @@ class StripeSEPAProvider(StripeIntentProvider):
         if data is not None:
             payment.attrs.mandats_id = data["mandate_reference"]
             payment.attrs.last4 = data["last4"]
-            payment.save()
-            result = sepa_notification.send(sender=payment, data=data)
-            if not any([x[1] for x in result]):
-                send_sepa_mail(payment, data)
+            payment.save(update_fields=["extra_data", "modified"])
+
+            from ..tasks import send_sepa_notification_task
+
+            # Send the debit notification only once the surrounding
+            # transaction has committed, and off the worker's back
+            transaction.on_commit(
+                lambda: send_sepa_notification_task.delay(payment.id, data)
+            )
 
 
 class StripeSofortProvider(StripeWebhookMixin, StripeProvider):
@@ -1033,23 +1363,32 @@ class StripeSofortProvider(StripeWebhookMixin, StripeProvider):
             # source has not been charged yet
             return
         try:
-            charge = stripe.Charge.retrieve(payment.transaction_id)
+            charge = retrieve_cached(stripe.Charge, payment.transaction_id)
         except stripe.error.InvalidRequestError:
             # charge is not yet available
             return
         if charge.status == "succeeded":
             payment.change_status(PaymentStatus.CONFIRMED)
-            payment.save()
             return True
 
     def get_form(self, payment, data=None):
         if payment.transaction_id:
             raise RedirectNeeded(payment.get_success_url())
         else:
+            # Guard against refreshes and double submits creating
+            # dangling sources: first caller wins, others reuse its
+            # source id once available
+            guard_key = "froide_payment:sofort_source:{}".format(payment.token)
+            if not cache.add(guard_key, "pending", 60):
+                source_id = cache.get(guard_key)
+                if source_id and source_id != "pending":
+                    payment.transaction_id = source_id
+                    payment.save(update_fields=["transaction_id", "modified"])
+                    raise RedirectNeeded(payment.get_success_url())
             try:
                 source = stripe.Source.create(
                     type="sofort",
-                    amount=int(payment.total * 100),
+                    amount=payment.amount_cents,
                     currency=payment.currency,
                     statement_descriptor=get_statement_descriptor(payment),
                     redirect={
@@ -1060,11 +1399,12 @@ class StripeSofortProvider(StripeWebhookMixin, StripeProvider):
                     },
                 )
                 payment.transaction_id = source.id
+                payment.save(update_fields=["transaction_id", "modified"])
                 payment.change_status(PaymentStatus.INPUT)
-                payment.save()
+                cache.set(guard_key, source.id, 60)
             except stripe.error.StripeError:
+                cache.delete(guard_key)
                 payment.change_status(PaymentStatus.ERROR)
-                payment.save()
                 # charge_id = e.json_body['error']['charge']
                 raise RedirectNeeded(payment.get_failure_url())
         if source.status == "chargeable":
@@ -1079,17 +1419,13 @@ class StripeSofortProvider(StripeWebhookMixin, StripeProvider):
             source_id = request.GET.get("source")
             if source_id is None:
                 return None
-            Payment = get_payment_model()
-            try:
-                payment = Payment.objects.get(
-                    transaction_id=source_id,
-                )
-            except Payment.DoesNotExist:
-                return None
-            return payment.token
+            return self.get_payment_token_by_id(source_id)
         return super().get_token_from_request(request=request, payment=payment)
 
     def process_data(self, payment, request):
+        if payment.variant != self.provider_name:
+            # This payment reached the wrong provider implementation endpoint
+            return HttpResponse(status=204)
         if request.method == "GET":
             # Redirect (not webhook)
             try:
@@ -1097,21 +1433,22 @@ class StripeSofortProvider(StripeWebhookMixin, StripeProvider):
                 client_secret = request.GET["client_secret"]
             except KeyError:
                 payment.change_status(PaymentStatus.ERROR)
-                payment.save()
                 return redirect(payment.get_failure_url())
+            if request.GET.get("redirect_status") == "succeeded":
+                # Trust the redirect state, the webhook confirms the
+                # charge; skips a Source.retrieve on the happy path
+                payment.change_status(PaymentStatus.PENDING)
+                return redirect(payment.get_success_url())
             try:
                 source = stripe.Source.retrieve(source_id, client_secret=client_secret)
             except stripe.error.StripeError:
                 payment.change_status(PaymentStatus.ERROR)
-                payment.save()
                 return redirect(payment.get_failure_url())
             if source.status in ("canceled", "failed"):
-                payment.save()
                 payment.change_status(PaymentStatus.REJECTED)
                 return redirect(payment.get_failure_url())
             # Charging takes place in webhook
             payment.change_status(PaymentStatus.PENDING)
-            payment.save()
             return redirect(payment.get_success_url())
         # Process web hook
         logger.info("Incoming Sofort Webhook")
@@ -1119,31 +1456,40 @@ class StripeSofortProvider(StripeWebhookMixin, StripeProvider):
 
     def update_payment(self, payment):
         tn_id = payment.transaction_id
-        assert tn_id.startswith(("ch_", "py_"))
-        charge = stripe.Charge.retrieve(tn_id)
-        payment.captured_amount = Decimal(charge.amount) / 100
-        txn = self.get_balance_transaction(charge.balance_transaction)
+        if not tn_id.startswith(("ch_", "py_")):
+            raise ValueError("Unexpected transaction id %r" % tn_id)
+        charge = retrieve_cached(stripe.Charge, tn_id, expand=["balance_transaction"])
+        payment.captured_amount = money_from_cents(charge.amount)
+        txn = charge.balance_transaction
+        if isinstance(txn, str):
+            txn = self.get_balance_transaction(txn)
         if txn is not None:
-            payment.received_amount = Decimal(txn.net) / 100
+            payment.received_amount = money_from_cents(txn.net)
             payment.received_timestamp = convert_utc_timestamp(txn.created)
+        payment.save(
+            update_fields=[
+                "captured_amount",
+                "received_amount",
+                "received_timestamp",
+                "modified",
+            ]
+        )
         if charge.status == "succeeded":
             payment.change_status(PaymentStatus.CONFIRMED)
-        payment.save()
 
     def charge_source(self, payment, source):
         try:
             charge = stripe.Charge.create(
-                amount=int(payment.total * 100),
+                amount=payment.amount_cents,
                 currency=payment.currency,
                 source=source.id,
             )
         except stripe.error.StripeError:
             payment.change_status(PaymentStatus.ERROR)
-            payment.save()
             raise RedirectNeeded(payment.get_failure_url())
         payment.transaction_id = charge.id
+        payment.save(update_fields=["transaction_id", "modified"])
         payment.change_status(PaymentStatus.PENDING)
-        payment.save()
 
     def source_chargeable(self, request, source):
         logger.info("Sofort Webhook: source chargeable: %d", source.id)
@@ -1159,18 +1505,28 @@ class StripeSofortProvider(StripeWebhookMixin, StripeProvider):
     def charge_succeeded(self, request, charge):
         logger.info("Sofort Webhook: charge succeeded: %d", charge.id)
 
+        invalidate_cached_object(charge.id)
         payment = self.get_payment_by_id(charge.id)
         if payment is None:
             return
 
-        payment.attrs.charge = json.dumps(charge)
-        payment.captured_amount = Decimal(charge.amount) / 100
+        # Store a small projection, the full charge object is ~10 KB
+        payment.attrs.charge = trim_charges([charge])[0]
+        payment.captured_amount = money_from_cents(charge.amount)
         txn = self.get_balance_transaction(charge.balance_transaction)
         if txn is not None:
-            payment.received_amount = Decimal(txn.net) / 100
+            payment.received_amount = money_from_cents(txn.net)
             payment.received_timestamp = convert_utc_timestamp(txn.created)
+        payment.save(
+            update_fields=[
+                "extra_data",
+                "captured_amount",
+                "received_amount",
+                "received_timestamp",
+                "modified",
+            ]
+        )
         payment.change_status(PaymentStatus.CONFIRMED)
-        payment.save()
 
     def charge_failed(self, request, charge):
         logger.info("Sofort Webhook: charge failed: %d", charge.id)
@@ -1179,7 +1535,10 @@ class StripeSofortProvider(StripeWebhookMixin, StripeProvider):
         if payment is None:
             return
 
-        payment.attrs.charge = json.dumps(charge)
+        charge_info = trim_charges([charge])[0]
+        charge_info["failure_code"] = charge.failure_code
+        charge_info["failure_message"] = charge.failure_message
+        payment.attrs.charge = charge_info
         payment.captured_amount = Decimal("0.0")
+        payment.save(update_fields=["extra_data", "captured_amount", "modified"])
         payment.change_status(PaymentStatus.REJECTED)
-        payment.save()
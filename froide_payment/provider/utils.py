@@ -1,5 +1,14 @@
-from collections import namedtuple
+from dataclasses import dataclass
 
-CancelInfo = namedtuple("CancelInfo", ("can_cancel", "message"))
 
-ModifyInfo = namedtuple("ModifyInfo", ("can_modify", "message", "can_schedule"))
+@dataclass(slots=True, frozen=True)
+class CancelInfo:
+    can_cancel: bool
+    message: str
+
+
+@dataclass(slots=True, frozen=True)
+class ModifyInfo:
+    can_modify: bool
+    message: str
+    can_schedule: bool
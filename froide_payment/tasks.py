@@ -5,7 +5,7 @@ from django.utils import timezone
 
 from celery import shared_task
 
-from .utils import cleanup, create_recurring_order
+from .utils import cleanup, create_recurring_orders
 
 
 @shared_task(name="froide_payment.cleanup")
@@ -26,5 +26,81 @@ def lastschrift_subscriptions():
     active_subscriptions = Subscription.objects.filter(
         active=True, plan__provider=provider_name
     ).filter(Q(next_date__isnull=True) | Q(next_date__lte=four_days_ago))
-    for subscription in active_subscriptions:
-        create_recurring_order(subscription, now=now)
+    create_recurring_orders(active_subscriptions, now=now)
+
+
+@shared_task(name="froide_payment.reconcile_order")
+def reconcile_order(order_id):
+    from payments import get_payment_model
+    from payments.core import provider_factory
+
+    from .models import PaymentStatus
+
+    Payment = get_payment_model()
+    payments = Payment.objects.filter(order_id=order_id)
+    if payments.filter(status=PaymentStatus.CONFIRMED).exists():
+        return
+    for payment in payments:
+        provider = provider_factory(payment.variant)
+        if hasattr(provider, "update_status"):
+            if provider.update_status(payment):
+                break
+
+
+@shared_task(name="froide_payment.send_lastschrift_mail")
+def send_lastschrift_mail_task(payment_id, note=""):
+    from payments import get_payment_model
+
+    from .utils import send_lastschrift_mail
+
+    Payment = get_payment_model()
+    try:
+        payment = Payment.objects.select_related("order").get(id=payment_id)
+    except Payment.DoesNotExist:
+        return
+    send_lastschrift_mail(payment, note=note)
+
+
+@shared_task(name="froide_payment.send_sepa_notification")
+def send_sepa_notification_task(payment_id, data):
+    from payments import get_payment_model
+
+    from .signals import sepa_notification
+    from .utils import send_sepa_mail
+
+    Payment = get_payment_model()
+    try:
+        payment = Payment.objects.select_related("order").get(id=payment_id)
+    except Payment.DoesNotExist:
+        return
+    result = sepa_notification.send(sender=payment, data=data)
+    if not any(x[1] for x in result):
+        send_sepa_mail(payment, data)
+
+
+@shared_task(
+    name="froide_payment.process_paypal_webhook",
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    retry_backoff_max=600,
+    max_retries=5,
+)
+def process_paypal_webhook(data):
+    from payments.core import provider_factory
+
+    provider = provider_factory("paypal")
+    provider.process_webhook_event(data)
+
+
+@shared_task(
+    name="froide_payment.process_stripe_event",
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    retry_backoff_max=600,
+    max_retries=5,
+)
+def process_stripe_event(variant, event_dict):
+    from payments.core import provider_factory
+
+    provider = provider_factory(variant)
+    provider.process_webhook_event(event_dict)
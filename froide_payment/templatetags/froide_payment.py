@@ -1,16 +1,25 @@
+from functools import lru_cache
+
 from django import template
-from django.template.loader import render_to_string
+from django.template.loader import select_template
 
 register = template.Library()
 
 
-@register.simple_tag
-def render_payment_status(payment):
+@lru_cache(maxsize=64)
+def get_status_template(variant):
+    # Resolve the template once per variant, not per render
     template_base = "froide_payment/payment/status/{}.html"
-    return render_to_string(
+    return select_template(
         [
-            template_base.format(payment.variant),
+            template_base.format(variant),
             template_base.format("default"),
-        ],
-        {"payment": payment, "order": payment.order},
+        ]
+    )
+
+
+@register.simple_tag
+def render_payment_status(payment):
+    return get_status_template(payment.variant).render(
+        {"payment": payment, "order": payment.order}
     )
@@ -1,16 +1,19 @@
 import csv
+import io
 import logging
 from datetime import timedelta
 from decimal import Decimal
 
 from django.conf import settings
 from django.core.mail import send_mail
-from django.db.models import Count, Q
-from django.http import StreamingHttpResponse
+from django.db.models import Exists, OuterRef, Prefetch
+from django.http import HttpResponse, StreamingHttpResponse
 from django.template.loader import render_to_string
 from django.utils import formats, timezone
 from django.utils.translation import gettext_lazy as _
 
+import orjson
+
 logger = logging.getLogger(__name__)
 
 
@@ -25,6 +28,13 @@ def get_client_ip(request=None):
     return ip
 
 
+def json_response(data, status=200):
+    # Skip Django's JSON encoder, these payloads are plain dicts
+    return HttpResponse(
+        orjson.dumps(data), content_type="application/json", status=status
+    )
+
+
 def get_payment_defaults(order, request=None):
     return {
         "total": order.amount,
@@ -49,25 +59,43 @@ def dicts_to_csv_response(generator, name="export.csv"):
         dict_to_csv_stream(generator), content_type="text/csv"
     )
     response["Content-Disposition"] = 'attachment; filename="%s"' % name
+    # Exports should stream straight through: do not cache and tell
+    # nginx not to buffer the whole file before sending
+    response["Cache-Control"] = "no-store"
+    response["X-Accel-Buffering"] = "no"
     return response
 
 
-class FakeFile(object):
-    def write(self, string):
-        self._last_string = string.encode("utf-8")
+def queryset_to_csv_response(queryset, fields, name="export.csv"):
+    # Stream straight from a server-side cursor, the queryset is never
+    # fully materialized in memory
+    return dicts_to_csv_response(
+        queryset.values(*fields).iterator(chunk_size=2000), name=name
+    )
+
+
+CSV_STREAM_CHUNK_SIZE = 64 * 1024
 
 
 def dict_to_csv_stream(stream):
     writer = None
-    fake_file = FakeFile()
+    buffer = io.StringIO()
     for d in stream:
         if writer is None:
             field_names = list(d.keys())
-            writer = csv.DictWriter(fake_file, field_names)
-            writer.writeheader()
-            yield fake_file._last_string
-        writer.writerow(d)
-        yield fake_file._last_string
+            # Plain writer beats DictWriter, which re-maps the dict to
+            # a row on every call
+            writer = csv.writer(buffer)
+            writer.writerow(field_names)
+        writer.writerow([d[key] for key in field_names])
+        # Accumulate rows and hand out large chunks, one yield per row
+        # makes a syscall-heavy chunked response
+        if buffer.tell() > CSV_STREAM_CHUNK_SIZE:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
 
 
 def interval_description(interval):
@@ -133,12 +161,16 @@ def send_sepa_mail(payment, data):
     )
 
 
+UNSET = object()
+
+
 def create_recurring_order(
     subscription,
     remote_reference=None,
     now=None,
     force=False,
     remote_reference_is_unique=False,
+    last_order=UNSET,
 ):
     from .models import PaymentStatus
 
@@ -150,14 +182,18 @@ def create_recurring_order(
 
     provider_name = subscription.plan.provider
 
-    last_order = subscription.get_last_order()
+    if last_order is UNSET:
+        last_order = subscription.get_last_order()
 
     now += timedelta(days=1)
 
     if not force and last_order and now < last_order.service_end:
-        # Not yet due, set next_date correctly
+        # Not yet due, set next_date correctly with a narrow UPDATE
+        # that skips model signals
         subscription.next_date = last_order.service_end
-        subscription.save()
+        type(subscription).objects.filter(pk=subscription.pk).update(
+            next_date=subscription.next_date
+        )
         return
 
     if last_order:
@@ -177,24 +213,55 @@ def create_recurring_order(
     order = subscription.create_order(
         remote_reference=remote_reference,
         remote_reference_is_unique=remote_reference_is_unique,
+        last_order=last_order,
     )
     payment = order.get_or_create_payment(provider_name)
     subscription.last_date = order.created
     subscription.next_date = order.service_end
-    subscription.save()
+    type(subscription).objects.filter(pk=subscription.pk).update(
+        last_date=subscription.last_date, next_date=subscription.next_date
+    )
     if provider_name == "lastschrift":
         customer = subscription.customer
         customer_data = customer.data
         payment.attrs.mandats_id = customer_data.get("mandats_id", None)
         payment.attrs.iban = customer_data.get("iban", None)
+        payment.save(update_fields=["extra_data", "modified"])
 
     payment.change_status(PaymentStatus.PENDING)
-    payment.save()
     logger.info("Payment %s created for subscription %s", payment.id, subscription.id)
 
     return payment
 
 
+def create_recurring_orders(subscriptions, now=None):
+    """Run create_recurring_order over a batch of subscriptions.
+
+    The latest order of each subscription is prefetched in one query
+    instead of one SELECT per subscription. Orders and payments are
+    still created individually: payment creation has to send the
+    status_changed signal per payment, which bulk_create would skip.
+    """
+    from .models import Order
+
+    subscriptions = subscriptions.select_related("plan", "customer").prefetch_related(
+        Prefetch(
+            "orders",
+            queryset=Order.objects.order_by("-service_end")[:1],
+            to_attr="latest_orders",
+        )
+    )
+    payments = []
+    for subscription in subscriptions.iterator(chunk_size=500):
+        last_order = (
+            subscription.latest_orders[0] if subscription.latest_orders else None
+        )
+        payment = create_recurring_order(subscription, now=now, last_order=last_order)
+        if payment is not None:
+            payments.append(payment)
+    return payments
+
+
 def cleanup(time_ago=None):
     from .models import Customer, Order, Payment, PaymentStatus, Subscription
 
@@ -204,40 +271,34 @@ def cleanup(time_ago=None):
 
     # Delete payments that are more than 12 hours old
     # and still in waiting or input status
-    inactive_payments = Payment.objects.filter(
+    deleted, _ = Payment.objects.filter(
         created__lte=time_ago,
-    ).filter(Q(status=PaymentStatus.WAITING) | Q(status=PaymentStatus.INPUT))
-    logger.warn("Deleting %s inactive payments", inactive_payments.count())
-    inactive_payments.delete()
+        status__in=(PaymentStatus.WAITING, PaymentStatus.INPUT),
+    ).delete()
+    logger.warning("Deleted %s inactive payments", deleted)
 
-    # Get old orders without payments
-    non_payment_orders = (
+    # Delete old orders without payments, the anti-join lets the
+    # database probe the payment index per row instead of aggregating
+    deleted, _ = (
         Order.objects.filter(created__lte=time_ago)
-        .annotate(payment_count=Count("payments"))
-        .filter(payment_count=0)
+        .filter(~Exists(Payment.objects.filter(order=OuterRef("pk"))))
+        .delete()
     )
-    logger.warn("Deleting %s inactive orders", non_payment_orders.count())
-    non_payment_orders.delete()
+    logger.warning("Deleted %s inactive orders", deleted)
 
     # Delete older subscriptions without connected orders
-    non_order_subscriptions = (
-        Subscription.objects.filter(
-            created__lte=time_ago,
-        )
-        .annotate(order_count=Count("orders"))
-        .filter(order_count=0)
+    deleted, _ = (
+        Subscription.objects.filter(created__lte=time_ago)
+        .filter(~Exists(Order.objects.filter(subscription=OuterRef("pk"))))
+        .delete()
     )
-    logger.warn("Deleting %s inactive subscriptions", non_order_subscriptions.count())
-    non_order_subscriptions.delete()
+    logger.warning("Deleted %s inactive subscriptions", deleted)
 
     # Delete customers without order or subscriptions
-    dangling_customers = (
+    deleted, _ = (
         Customer.objects.filter(created__lte=time_ago)
-        .annotate(
-            order_count=Count("orders"),
-            subscription_count=Count("subscriptions"),
-        )
-        .filter(order_count=0, subscription_count=0)
+        .filter(~Exists(Order.objects.filter(customer=OuterRef("pk"))))
+        .filter(~Exists(Subscription.objects.filter(customer=OuterRef("pk"))))
+        .delete()
     )
-    logger.warn("Deleting %s obsolete customers", dangling_customers.count())
-    dangling_customers.delete()
+    logger.warning("Deleted %s obsolete customers", deleted)
@@ -1,43 +1,85 @@
 import logging
-from functools import wraps
+from functools import lru_cache, wraps
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_permission_codename
+from django.core.cache import cache
 from django.core.exceptions import BadRequest
 from django.core.mail import mail_admins
-from django.http import JsonResponse
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.template.loader import select_template
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.http import require_POST
 from froide.helper.utils import render_403
 from payments import RedirectNeeded
-from payments.core import provider_factory
 
 from .forms import ModifySubscriptionForm
 from .models import Order, Payment, PaymentStatus, Subscription
+from .tasks import reconcile_order
+from .utils import json_response
 
 logger = logging.getLogger(__name__)
 
+PAYMENT_REDIRECT_CACHE_TTL = 30
+SUBSCRIPTION_ORDER_LIMIT = 20
+
+
+@lru_cache(maxsize=256)
+def order_kind_template(kind):
+    return "froide_payment/order/%s/detail.html" % "/".join(kind.lower().split("."))
+
+
+@lru_cache(maxsize=64)
+def payment_template(variant):
+    # Resolve once per variant, the fallback walk over the template
+    # loaders stats the filesystem for the missing variant template
+    return select_template(
+        [
+            "froide_payment/payment/%s.html" % variant,
+            "froide_payment/payment/default.html",
+        ]
+    )
+
+
+@lru_cache(maxsize=64)
+def subscription_templates(provider):
+    default = "froide_payment/subscription/default.html"
+    if provider:
+        return (
+            "froide_payment/subscription/%s/detail.html" % provider.lower(),
+            default,
+        )
+    return (default,)
+
+
+@lru_cache(maxsize=None)
+def get_change_permission(model):
+    opts = model._meta
+    return "%s.%s" % (opts.app_label, get_permission_codename("change", opts))
+
 
 def can_access(obj, user):
     if user.is_superuser:
         return True
 
-    opts = obj._meta
-    codename = get_permission_codename("change", opts)
-    perm = "%s.%s" % (opts.app_label, codename)
-    if user.is_staff and user.has_perm(perm):
+    # Compare FK ids, loading the related user or consulting the
+    # permission machinery is only needed for foreign staff access
+    if obj.user_id is None or obj.user_id == user.id:
         return True
-    if obj.user and user != obj.user:
+    if not user.is_staff:
         return False
-    return True
+    return user.has_perm(get_change_permission(type(obj)))
 
 
 def check_subscription_access(func):
     @wraps(func)
     def inner(request, token, *args, **kwargs):
-        subscription = get_object_or_404(Subscription, token=token)
+        subscription = get_object_or_404(
+            Subscription.objects.select_related("plan", "customer", "customer__user"),
+            token=token,
+        )
         user = request.user
         customer = subscription.customer
         if can_access(customer, user):
@@ -48,34 +90,38 @@ def check_subscription_access(func):
 
 
 def order_detail(request, token):
-    order = get_object_or_404(Order, token=token)
-    user = request.user
-
     if "json" in request.META.get("HTTP_ACCEPT", ""):
-        return JsonResponse({"name": order.get_full_name()})
+        # Polling endpoint: a minimal SELECT, no joins or payments
+        order = get_object_or_404(
+            Order.objects.only("first_name", "last_name"), token=token
+        )
+        return json_response({"name": order.get_full_name()})
+
+    order = get_object_or_404(
+        Order.objects.select_related("user", "subscription__plan"), token=token
+    )
+    user = request.user
 
     if not can_access(order, user):
         return redirect("/")
 
-    payments = Payment.objects.filter(order=order)
-    templates = []
+    payments = Payment.objects.filter(order=order).select_related("order")
+    default = "froide_payment/order/default.html"
     if order.kind:
-        part = "/".join(order.kind.lower().split("."))
-        templates.append("froide_payment/order/%s/detail.html" % part)
-    templates.append("froide_payment/order/default.html")
+        templates = (order_kind_template(order.kind), default)
+    else:
+        templates = (default,)
 
     domain_object = order.get_domain_object()
 
     result = request.GET.get("result")
     if result == "success":
-        any_confirmed = any(
-            payment.status == PaymentStatus.CONFIRMED for payment in payments
-        )
+        # EXISTS probe instead of materializing the payments here
+        any_confirmed = payments.filter(status=PaymentStatus.CONFIRMED).exists()
         if not any_confirmed:
-            for payment in payments:
-                provider = provider_factory(payment.variant)
-                if hasattr(provider, "update_status"):
-                    provider.update_status(payment)
+            # Reconcile with the provider off the request thread, the
+            # webhook or a refresh picks up the confirmed state
+            reconcile_order.delay(order.id)
 
     ctx = {
         "payments": payments,
@@ -87,21 +133,20 @@ def order_detail(request, token):
 
 
 def order_success(request, token):
-    order = get_object_or_404(Order, token=token)
+    order = get_object_or_404(
+        Order.objects.select_related("user", "subscription__plan"), token=token
+    )
     user = request.user
     if not can_access(order, user):
         return redirect("/")
 
-    payments = Payment.objects.filter(order=order)
-
-    any_confirmed = any(
-        payment.status == PaymentStatus.CONFIRMED for payment in payments
-    )
+    any_confirmed = Payment.objects.filter(
+        order=order, status=PaymentStatus.CONFIRMED
+    ).exists()
     if not any_confirmed:
-        for payment in payments:
-            provider = provider_factory(payment.variant)
-            if hasattr(provider, "update_status"):
-                provider.update_status(payment)
+        # The success redirect does not depend on the reconciliation
+        # result, run it in the worker
+        reconcile_order.delay(order.id)
 
     return redirect(order.get_success_url())
 
@@ -116,7 +161,9 @@ def order_failed(request, token):
 
 
 def start_payment(request, token, variant):
-    order = get_object_or_404(Order, token=token)
+    order = get_object_or_404(
+        Order.objects.select_related("user", "subscription"), token=token
+    )
     if order.is_fully_paid():
         return redirect(order.get_success_url())
 
@@ -126,33 +173,44 @@ def start_payment(request, token, variant):
     payment = order.get_or_create_payment(variant, request=request)
 
     data = None
+    cache_key = None
     if request.method == "POST":
         data = request.POST
+    else:
+        # Refresh bursts should not re-hit the payment provider, the
+        # redirect for a payment in a given status is stable
+        cache_key = "froide_payment:payment_redirect:{}:{}".format(
+            payment.id, payment.status
+        )
+        redirect_url = cache.get(cache_key)
+        if redirect_url:
+            return redirect(redirect_url)
     try:
         form = payment.get_form(data=data)
     except RedirectNeeded as redirect_to:
+        if cache_key is not None:
+            cache.set(cache_key, str(redirect_to), PAYMENT_REDIRECT_CACHE_TTL)
         return redirect(str(redirect_to))
 
-    default_template = "froide_payment/payment/default.html"
-    template = "froide_payment/payment/%s.html" % variant
     ctx = {
         "form": form,
         "payment": payment,
         "order": order,
     }
-    return render(request, [template, default_template], ctx)
+    return HttpResponse(payment_template(variant).render(ctx, request))
 
 
 @check_subscription_access
 def subscription_detail(request, subscription):
-    templates = []
-    plan = subscription.plan
-    if plan.provider:
-        part = plan.provider.lower()
-        templates.append("froide_payment/subscription/%s/detail.html" % part)
-    templates.append("froide_payment/subscription/default.html")
-
-    orders = Order.objects.filter(subscription=subscription).order_by("-created")
+    templates = subscription_templates(subscription.plan.provider)
+
+    # Cap the rendered history, long-running subscriptions can
+    # accumulate hundreds of orders
+    orders = (
+        Order.objects.filter(subscription=subscription)
+        .select_related("subscription__plan")
+        .order_by("-created")[:SUBSCRIPTION_ORDER_LIMIT]
+    )
 
     ctx = {
         "orders": orders,
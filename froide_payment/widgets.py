@@ -5,10 +5,15 @@ from django.conf import settings
 class PriceInput(forms.TextInput):
     template_name = "froide_payment/widgets/price_input.html"
 
+    def __init__(self, attrs=None):
+        # Static attrs live on the widget, get_context does not need to
+        # rebuild them per render
+        defaults = {"class": "form-control col-3", "pattern": "[\\d\\.,]*"}
+        if attrs:
+            defaults.update(attrs)
+        super().__init__(attrs=defaults)
+
     def get_context(self, name, value, attrs):
-        ctx = super(PriceInput, self).get_context(name, value, attrs)
-        ctx["widget"].setdefault("attrs", {})
-        ctx["widget"]["attrs"]["class"] = "form-control col-3"
-        ctx["widget"]["attrs"]["pattern"] = "[\\d\\.,]*"
+        ctx = super().get_context(name, value, attrs)
         ctx["currency"] = settings.DEFAULT_CURRENCY
         return ctx